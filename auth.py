@@ -1,34 +1,21 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Iterable, Optional
 from jose import JWTError, jwt
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from models import User
 from settings import Config
-import hashlib
-import secrets
+from password_hashing import dummy_hash, password_hasher
+from write_pipeline import write_pipeline
+from user_cache import UserSnapshot, user_cache, user_changed, user_updated
+from presence_store import presence_store
+from presence import presence_notifier
+from event_bus import event_bus
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash."""
-    try:
-        salt, stored_hash = hashed_password.split(':')
-        computed_hash = hashlib.sha256((salt + plain_password).encode()).hexdigest()
-        return secrets.compare_digest(computed_hash, stored_hash)
-    except Exception:
-        return False
-
-
-def get_password_hash(password: str) -> str:
-    """Hash a password."""
-    salt = secrets.token_hex(16)
-    hash_obj = hashlib.sha256((salt + password).encode())
-    return f"{salt}:{hash_obj.hexdigest()}"
-
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create a JWT access token."""
     to_encode = data.copy()
@@ -41,11 +28,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-async def get_user_by_username(session: AsyncSession, username: str) -> Optional[User]:
-    result = await session.execute(
-        select(User).where(User.username == username)
-    )
-    return result.scalar_one_or_none()
+async def get_user_by_username(session: AsyncSession, username: str) -> Optional[UserSnapshot]:
+    user = user_cache.get_by_username(username)
+    if user is None:
+        token = user_cache.begin_fill()
+        result = await session.execute(
+            select(User).where(User.username == username)
+        )
+        user = result.scalar_one_or_none()
+        if user is None:
+            return None
+        user = user_cache.fill(user, token)
+    return presence_store.current(user)
 
 
 async def get_user_by_email(session: AsyncSession, email: str) -> Optional[User]:
@@ -55,23 +49,69 @@ async def get_user_by_email(session: AsyncSession, email: str) -> Optional[User]
     return result.scalar_one_or_none()
 
 
-async def get_user_by_id(session: AsyncSession, user_id: int) -> Optional[User]:
-    result = await session.execute(
-        select(User).where(User.id == user_id)
-    )
-    return result.scalar_one_or_none()
-
-
-async def authenticate_user(session: AsyncSession, username: str, password: str) -> Optional[User]:
+async def get_user_by_id(session: AsyncSession, user_id: int) -> Optional[UserSnapshot]:
+    user = user_cache.get(user_id)
+    if user is None:
+        token = user_cache.begin_fill()
+        result = await session.execute(
+            select(User).where(User.id == user_id)
+        )
+        user = result.scalar_one_or_none()
+        if user is None:
+            return None
+        user = user_cache.fill(user, token)
+    return presence_store.current(user)
+
+
+async def get_users_by_ids(session: AsyncSession, user_ids: Iterable[int]) -> Dict[int, UserSnapshot]:
+    """Users by id; cached ones first, the others with a single IN query."""
+    users, missing = {}, []
+    for user_id in user_ids:
+        user = user_cache.get(user_id)
+        if user is not None:
+            users[user_id] = user
+        else:
+            missing.append(user_id)
+    if missing:
+        token = user_cache.begin_fill()
+        result = await session.execute(
+            select(User).where(User.id.in_(missing))
+        )
+        for user in result.scalars():
+            users[user.id] = user_cache.fill(user, token)
+    return {user_id: presence_store.current(user) for user_id, user in users.items()}
+
+
+async def authenticate_user(session: AsyncSession, username: str, password: str) -> Optional[UserSnapshot]:
+    """The user if the password is right; raises HasherBusy.
+    
+    `session` is only read from, and its transaction ended before the
+    password is checked: no connection is held while hashing. Hashes made
+    with a legacy scheme or another cost are replaced through the write
+    pipeline.
+    """
     user = await get_user_by_username(session, username)
-    if not user:
+    await session.rollback()
+    if not user or not user.hashed_password:
+        # As slow as a real check: the timing must not tell which usernames exist
+        await password_hasher.verify(password, dummy_hash())
         return None
-    if not verify_password(password, user.hashed_password):
+    matches, needs_rehash = await password_hasher.verify(password, user.hashed_password)
+    if not matches:
         return None
+    if needs_rehash:
+        hashed_password = await password_hasher.hash(password)
+        await write_pipeline.set_password_hash(user.id, hashed_password)
+        user_updated(user.id, hashed_password=hashed_password)
+        password_hasher.rehashes += 1
     return user
 
 
-async def create_user(session: AsyncSession, user_data) -> User:
+async def create_user(user_data) -> UserSnapshot:
+    """Hash the password, then insert the user through the write pipeline.
+    
+    Raises HasherBusy, or IntegrityError if the username or email is taken.
+    """
     from pydantic import BaseModel
     
     class UserCreate(BaseModel):
@@ -83,36 +123,42 @@ async def create_user(session: AsyncSession, user_data) -> User:
     if isinstance(user_data, dict):
         user_data = UserCreate(**user_data)
     
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
     
-    user = User(
+    user = await write_pipeline.insert_user(
         username=user_data.username,
         email=user_data.email,
         hashed_password=hashed_password,
         display_name=user_data.display_name,
-        is_online=True,
+        is_online=False,
         last_seen=datetime.utcnow()
     )
     
-    session.add(user)
-    await session.commit()
-    await session.refresh(user)
-    
     logger.info(f"Created user: {user.username}")
-    return user
+    return presence_store.current(user_changed(user, created=True))
 
 
-async def update_user_last_seen(session: AsyncSession, user_id: int):
-    user = await get_user_by_id(session, user_id)
-    if user:
-        user.last_seen = datetime.utcnow()
-        await session.commit()
+def update_user_last_seen(user_id: int):
+    presence_store.seen(user_id)
 
 
-async def set_user_online_status(session: AsyncSession, user_id: int, is_online: bool):
-    user = await get_user_by_id(session, user_id)
-    if user:
-        user.is_online = is_online
-        if not is_online:
-            user.last_seen = datetime.utcnow()
-        await session.commit()
+def _on_status_declared(data: dict):
+    user_id, is_online = data["user_id"], data["is_online"]
+    if presence_store.declare(user_id, is_online, write=data["worker_id"] == event_bus.worker_id):
+        presence_notifier.status_changed(user_id, is_online)
+
+
+event_bus.on("status_declared", _on_status_declared)
+
+
+def set_user_online_status(user_id: int, is_online: bool):
+    """Set the status of a user, on every worker.
+    
+    Only matters while the user has no WebSocket open: with one, they are
+    online. Written back to the users table with the next presence flush.
+    """
+    event_bus.publish("status_declared", {
+        "user_id": user_id,
+        "is_online": is_online,
+        "worker_id": event_bus.worker_id
+    })
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from jose import JWTError, jwt
 from datetime import datetime
 
@@ -10,40 +11,70 @@ from auth import (
 )
 from main import async_session
 from schemas import UserCreate, UserLogin, Token, UserResponse
-from dependencies import get_current_user, get_db
+from dependencies import get_current_user, get_db, get_read_db, get_token
+from token_auth import token_verifier
+from password_hashing import HasherBusy
+from user_cache import user_cache
 
 router = APIRouter()
 
 
+def _busy_exception() -> HTTPException:
+    # Password hashing is saturated (login storm)
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many logins, try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
 @router.post("/register", response_model=UserResponse)
-async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_read_db)):
     """Register a new user."""
-    # Check if username exists
-    user = await get_user_by_username(db, user_data.username)
-    if user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already registered"
-        )
+    # Check if username exists (free names are remembered a short while,
+    # the unique constraints have the last word)
+    if not user_cache.is_absent("username", user_data.username):
+        user = await get_user_by_username(db, user_data.username)
+        if user:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Username already registered"
+            )
+        user_cache.mark_absent("username", user_data.username)
     
     # Check if email exists
-    user = await get_user_by_email(db, user_data.email)
-    if user:
+    if not user_cache.is_absent("email", user_data.email):
+        user = await get_user_by_email(db, user_data.email)
+        if user:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Email already registered"
+            )
+        user_cache.mark_absent("email", user_data.email)
+    
+    # Create user (no connection is held while the password is hashed)
+    await db.rollback()
+    try:
+        user = await create_user(user_data)
+    except HasherBusy:
+        raise _busy_exception()
+    except IntegrityError:
+        # Taken since the checks above
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
+            detail="Username or email already registered"
         )
     
-    # Create user
-    user = await create_user(db, user_data)
-    
     return user
 
 
 @router.post("/login", response_model=Token)
-async def login(credentials: UserLogin, db: AsyncSession = Depends(get_db)):
+async def login(credentials: UserLogin, db: AsyncSession = Depends(get_read_db)):
     """Login with username and password."""
-    user = await authenticate_user(db, credentials.username, credentials.password)
+    try:
+        user = await authenticate_user(db, credentials.username, credentials.password)
+    except HasherBusy:
+        raise _busy_exception()
     
     if not user:
         raise HTTPException(
@@ -71,6 +102,14 @@ async def get_me(current_user = Depends(get_current_user)):
 
 
 @router.post("/logout")
-async def logout(current_user = Depends(get_current_user)):
-    """Logout user."""
+async def logout(
+    token: str = Depends(get_token),
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Logout user.
+    
+    The token is revoked at once, on every worker.
+    """
+    await token_verifier.revoke(db, token)
     return {"message": "Logged out successfully"}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Benchmark concurrent logins and the event loop lag they cause.
+
+Runs N concurrent password verifications on one event loop, as a login
+storm does on one worker, while a probe task measures how late a 10 ms
+timer fires (the delay every request and WebSocket frame would see):
+
+- ``legacy``: salted SHA-256, inline (the old scheme)
+- ``inline``: scrypt at the configured cost, on the event loop
+- ``pool``: scrypt through password_hasher (what auth.authenticate_user does)
+
+    python bench_login.py --logins 200 --workers 2
+
+Reference figures, defaults (200 logins, 2 workers, n = 2**14), CPython
+3.11, one core:
+
+- legacy: 55,000 logins/s, lag p99 2.6 ms
+- inline: 17 logins/s, lag p99 11,800 ms (the loop is blocked for the storm)
+- pool: 18 logins/s, lag p99 4.5 ms, max 8.8 ms
+
+Throughput scales with PASSWORD_HASH_WORKERS up to the number of cores;
+lag stays flat whatever the number of workers.
+"""
+import argparse
+import asyncio
+import hashlib
+import secrets
+import statistics
+import time
+
+from settings import Config
+import password_hashing
+from password_hashing import password_hasher
+
+PASSWORD = "correct horse battery staple"
+
+
+def legacy_hash(password: str) -> str:
+    salt = secrets.token_hex(16)
+    return f"{salt}:{hashlib.sha256((salt + password).encode()).hexdigest()}"
+
+
+async def probe(lags: list, stop: asyncio.Event, interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append((loop.time() - expected) * 1000)
+
+
+async def storm(verify, stored: str, logins: int):
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[verify(PASSWORD, stored) for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+    assert all(matches for matches, _ in results)
+    return logins / elapsed, lags
+
+
+def report(label: str, rate: float, lags: list):
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if len(lags) >= 100 else lags[-1]
+    print(f"  {label:<7} {rate:10,.0f} logins/s   lag p50 {statistics.median(lags):8.1f} ms"
+          f"   p99 {p99:8.1f} ms   max {lags[-1]:8.1f} ms")
+
+
+async def run(args):
+    stored = password_hashing.hash_password(PASSWORD)
+    legacy = legacy_hash(PASSWORD)
+
+    async def inline(password, stored):
+        return password_hashing.verify_password(password, stored)
+
+    print(f"{args.logins} concurrent logins, scrypt n = 2**{Config.PASSWORD_SCRYPT_LOG_N}, "
+          f"{Config.PASSWORD_HASH_WORKERS} workers:")
+    report("legacy", *await storm(inline, legacy, args.logins))
+    report("inline", *await storm(inline, stored, args.logins))
+    report("pool", *await storm(password_hasher.verify, stored, args.logins))
+    password_hasher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=Config.PASSWORD_HASH_WORKERS)
+    parser.add_argument("--log-n", type=int, default=Config.PASSWORD_SCRYPT_LOG_N)
+    args = parser.parse_args()
+    Config.PASSWORD_HASH_WORKERS = args.workers
+    Config.PASSWORD_SCRYPT_LOG_N = args.log_n
+    Config.PASSWORD_HASH_MAX_PENDING = max(Config.PASSWORD_HASH_MAX_PENDING, args.logins)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
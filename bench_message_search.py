@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Benchmark full-text message search against a LIKE scan.
+
+Seeds a throwaway database with users, chats and N messages of synthetic
+text (words drawn from a Zipf distribution, so there are very common and
+very rare terms), builds the FTS5 index the way the migrations do, then
+times searches for rare, medium and common words as random users:
+
+- ``fts``: the query behind ``GET /api/messages/search`` (BM25 order)
+- ``like``: ``content LIKE '%word%'`` over the same chats, newest first
+
+Searches run with the production profile's connection pragmas (page cache
+and mmap size, see db_profile.py). Insert throughput is measured before and after the index exists, since the
+triggers keeping it in sync add work to every send.
+
+    python bench_message_search.py --rows 2000000
+
+Reference figures, defaults (2M messages, users in 50 chats of 20,000),
+CPython 3.11, SQLite 3.40, p50:
+
+- rare words: fts 0.6 ms, like 10.4 ms
+- medium words: fts 5.7 ms, like 9.2 ms
+- common words: fts 270 ms (a user's 50 chats hold fewer than
+  ``Config.SEARCH_MAX_MATCHES`` of its matches, so every match is walked),
+  like 2.7 ms (it stops at the first 20 hits, newest first)
+- index: 96 MB, built in 18 s; inserts 14,000/s without it, 4,300/s with it
+
+The LIKE scan grows with the history of the caller's chats, FTS with the
+number of matches.
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, text
+
+from models import Base
+from db_profile import connection_pragmas
+from settings import Config
+import message_search
+
+LIKE_QUERY = (
+    "SELECT m.id FROM messages m "
+    "JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = :user_id "
+    "WHERE m.content LIKE :pattern ORDER BY m.id DESC LIMIT :limit"
+)
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list:
+    syllables = [c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def seed(path: str, args, vocabulary: list):
+    rng = random.Random(args.seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.executemany(
+        "INSERT INTO users (id, username, email, hashed_password, display_name) VALUES (?, ?, ?, '', ?)",
+        ((i, f"user{i}", f"user{i}@example.com", f"User {i}") for i in range(1, args.users + 1))
+    )
+    db.executemany(
+        "INSERT INTO chats (id, title, type, owner_id) VALUES (?, ?, 'GROUP', 1)",
+        ((i, f"chat {i}") for i in range(1, args.chats + 1))
+    )
+    members = set()
+    for user_id in range(1, args.users + 1):
+        for chat_id in rng.sample(range(1, args.chats + 1), args.chats_per_user):
+            members.add((chat_id, user_id))
+    db.executemany("INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)", sorted(members))
+
+    batch = 50_000
+    for start in range(0, args.rows, batch):
+        rows = []
+        for message_id in range(start + 1, min(args.rows, start + batch) + 1):
+            words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(4, 16))
+            rows.append((message_id, rng.randint(1, args.chats), rng.randint(1, args.users), " ".join(words)))
+        db.executemany(
+            "INSERT INTO messages (id, chat_id, sender_id, content, content_type, status, is_edited, created_at) "
+            "VALUES (?, ?, ?, ?, 'text', 'SENT', 0, '2024-01-01 00:00:00')",
+            rows
+        )
+    db.commit()
+    db.close()
+
+
+def insert_rate(engine, rng: random.Random, args, vocabulary: list, count: int = 10_000) -> float:
+    """Messages inserted per second, in write-pipeline-sized transactions."""
+    batch = Config.WRITE_BATCH_MAX_SIZE
+    started = time.perf_counter()
+    for _ in range(0, count, batch):
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO messages (chat_id, sender_id, content, content_type, status, is_edited) "
+                "VALUES (?, ?, ?, 'text', 'SENT', 0)",
+                [(rng.randint(1, args.chats), 1, " ".join(rng.choices(vocabulary[:1000], k=10)))
+                 for _ in range(batch)]
+            )
+    return count / (time.perf_counter() - started)
+
+
+def timed(conn, statement, params) -> float:
+    started = time.perf_counter()
+    conn.execute(statement, params).fetchall()
+    return (time.perf_counter() - started) * 1000
+
+
+def timed_search(conn, user_id: int, word: str, limit: int) -> float:
+    """Same statement as message_search.search."""
+    match = message_search.match_expression(word)
+    started = time.perf_counter()
+    statement, params = message_search.search_statement(user_id, match, None, limit)
+    conn.execute(statement, params).fetchall()
+    return (time.perf_counter() - started) * 1000
+
+
+def report(label: str, times: list):
+    times.sort()
+    p95 = times[int(len(times) * 0.95) - 1] if len(times) >= 20 else times[-1]
+    print(f"  {label:<6} p50 {statistics.median(times):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=20_000)
+    parser.add_argument("--chats-per-user", type=int, default=50)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=50, help="searches per word class")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+
+        started = time.perf_counter()
+        seed(path, args, vocabulary)
+        print(f"seeded {args.rows:,} messages in {time.perf_counter() - started:.1f} s")
+
+        print(f"inserts without index: {insert_rate(engine, rng, args, vocabulary):,.0f} messages/s")
+
+        size_before = os.path.getsize(path)
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            message_search.ensure_index(conn)
+            message_search.rebuild(conn)
+            message_search.optimize(conn)
+        print(f"index built in {time.perf_counter() - started:.1f} s, "
+              f"{(os.path.getsize(path) - size_before) / 2**20:.0f} MB")
+        print(f"inserts with index:    {insert_rate(engine, rng, args, vocabulary):,.0f} messages/s")
+
+        word_classes = {"rare": vocabulary[-5000:], "medium": vocabulary[200:1000], "common": vocabulary[:10]}
+        # Search like the production profile's read connections do
+        search_engine = create_engine(f"sqlite:///{path}")
+
+        @event.listens_for(search_engine, "connect")
+        def _set_pragmas(dbapi_connection, connection_record):
+            for pragma in connection_pragmas(read_only=True):
+                dbapi_connection.execute(pragma)
+
+        with search_engine.connect() as conn:
+            for name, words in word_classes.items():
+                fts, like = [], []
+                for _ in range(args.queries):
+                    user_id = rng.randint(1, args.users)
+                    word = rng.choice(words)
+                    fts.append(timed_search(conn, user_id, word, args.limit))
+                    like.append(timed(conn, text(LIKE_QUERY),
+                                      {"user_id": user_id, "pattern": f"%{word}%", "limit": args.limit}))
+                print(f"{name} words:")
+                report("fts", fts)
+                report("like", like)
+
+
+if __name__ == "__main__":
+    main()
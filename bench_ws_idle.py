@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Measure server memory per idle WebSocket.
+
+Starts the server in a subprocess on a throwaway database, opens N idle
+WebSocket connections to /ws/ws/{user_id} (one user each) and reports the
+growth of the server's resident set size per connection.
+
+    python bench_ws_idle.py --connections 10000
+
+Linux only (reads /proc). Reference figures to track across releases,
+10,000 connections, CPython 3.11, uvicorn 0.24 with websockets 12:
+
+- ``--no-deflate``: about 39 KB per idle socket (42 KB before connection
+  records lost their per-socket writer task and queue)
+- with permessage-deflate: about 129 KB per idle socket; the compression
+  state is most of it, see ``Config.WS_PER_MESSAGE_DEFLATE``
+
+What remains is mostly uvicorn's and websockets' protocol objects, not
+ws_hub.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+from settings import Config
+from auth import create_access_token
+
+SERVER = """
+import sys
+import settings
+settings.Config.DATABASE_PATH = sys.argv[1]
+import uvicorn
+import main
+uvicorn.run(main.app, host="127.0.0.1", port=int(sys.argv[2]), log_level="warning",
+            ws="websockets", ws_per_message_deflate=sys.argv[3] == "1")
+"""
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not found")
+
+
+def wait_for_server(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def access_token(user_id: int) -> str:
+    # The users need not exist: sockets only check the token
+    return create_access_token({"sub": f"user{user_id}", "user_id": user_id})
+
+
+async def open_connections(port: int, count: int, batch: int):
+    sockets = []
+    for start in range(0, count, batch):
+        sockets += await asyncio.gather(*[
+            websockets.connect(f"ws://127.0.0.1:{port}/ws/ws/{user_id}?token={access_token(user_id)}",
+                               ping_interval=None)
+            for user_id in range(start + 1, min(count, start + batch) + 1)
+        ])
+    return sockets
+
+
+async def run(args, server_pid: int):
+    # Let startup allocations settle before the baseline
+    await asyncio.sleep(1)
+    baseline = rss_bytes(server_pid)
+    started = time.perf_counter()
+    sockets = await open_connections(args.port, args.connections, args.batch)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.settle)
+    loaded = rss_bytes(server_pid)
+
+    per_socket = (loaded - baseline) / args.connections
+    print(f"connections:       {args.connections} (permessage-deflate {'on' if args.deflate else 'off'})")
+    print(f"connect time:      {elapsed:.1f} s")
+    print(f"server RSS before: {baseline / 2**20:.1f} MB")
+    print(f"server RSS after:  {loaded / 2**20:.1f} MB")
+    print(f"bytes per socket:  {per_socket:,.0f}")
+
+    await asyncio.gather(*[ws.close() for ws in sockets])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=500, help="connections opened concurrently")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds to wait before measuring")
+    parser.add_argument("--deflate", action=argparse.BooleanOptionalAction, default=Config.WS_PER_MESSAGE_DEFLATE,
+                        help="negotiate permessage-deflate (default: Config.WS_PER_MESSAGE_DEFLATE)")
+    args = parser.parse_args()
+
+    # Client and server each need a descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, args.connections + 1000)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, "-c", SERVER, os.path.join(tmp, "bench.db"), str(args.port),
+             "1" if args.deflate else "0"],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        try:
+            wait_for_server(args.port)
+            asyncio.run(run(args, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
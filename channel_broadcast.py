@@ -0,0 +1,145 @@
+"""Live delivery of channel posts.
+
+A channel post is stored once, like any message, and nothing is written
+per subscriber: subscribers read the channel timeline on demand and their
+unread counters come from ``Chat.message_seq`` (see read_state.py).
+Events of groups too large to log per member (see update_log.py) are
+delivered the same way.
+
+Live delivery is published on the event bus, so every worker only handles
+its own sockets. Each worker walks whichever side is smaller in batches of
+``Config.CHANNEL_BROADCAST_BATCH``: the channel's subscribers (keyset scan
+over the chat_members primary key) or its locally connected users (checked
+against chat_members with one IN query per batch). It yields to the event
+loop between batches, so a post to a channel with 200k subscribers never
+holds the loop or a database connection for long.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import chat_members
+from settings import Config
+from ws_hub import hub, OutboundEvent
+from event_bus import event_bus
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelBroadcaster:
+    """Delivers channel posts to subscribers connected to this worker."""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Stats
+        self.posts = 0
+        self.batches = 0
+        self.deliveries = 0
+        self.post_ms_max = 0.0
+
+    def post(self, chat_id: int, payload: dict):
+        """Deliver a committed channel event on every worker."""
+        event_bus.publish("channel_post", {"chat_id": chat_id, "payload": payload})
+
+    def _enqueue(self, data: dict):
+        if self._queue is not None:
+            self._queue.put_nowait((data["chat_id"], data["payload"]))
+
+    async def _subscriber_batches(self, session_factory, chat_id: int):
+        """Subscribers of a channel, a batch (and a short session) at a time."""
+        after = 0
+        while True:
+            async with session_factory() as session:
+                result = await session.execute(
+                    select(chat_members.c.user_id)
+                    .where(chat_members.c.chat_id == chat_id)
+                    .where(chat_members.c.user_id > after)
+                    .order_by(chat_members.c.user_id)
+                    .limit(Config.CHANNEL_BROADCAST_BATCH)
+                )
+                batch = list(result.scalars())
+            if not batch:
+                return
+            yield batch
+            after = batch[-1]
+
+    async def _online_subscriber_batches(self, session_factory, chat_id: int):
+        """Locally connected users that subscribe to a channel, a batch at a time."""
+        online = hub.online_user_ids()
+        for start in range(0, len(online), Config.CHANNEL_BROADCAST_BATCH):
+            async with session_factory() as session:
+                result = await session.execute(
+                    select(chat_members.c.user_id)
+                    .where(chat_members.c.chat_id == chat_id)
+                    .where(chat_members.c.user_id.in_(online[start:start + Config.CHANNEL_BROADCAST_BATCH]))
+                )
+                batch = list(result.scalars())
+            yield batch
+
+    async def _subscriber_count(self, session: AsyncSession, chat_id: int) -> int:
+        result = await session.execute(
+            select(func.count()).select_from(chat_members).where(chat_members.c.chat_id == chat_id)
+        )
+        return result.scalar_one()
+
+    async def deliver(self, session_factory, chat_id: int, payload: dict):
+        """Send one post to the subscribers connected to this worker."""
+        started = time.perf_counter()
+        self.posts += 1
+        if not hub.by_user:
+            return
+        event = OutboundEvent(payload)  # serialized once for all subscribers
+        async with session_factory() as session:
+            subscribers = await self._subscriber_count(session, chat_id)
+
+        if subscribers <= len(hub.by_user):
+            batches = self._subscriber_batches(session_factory, chat_id)
+        else:
+            batches = self._online_subscriber_batches(session_factory, chat_id)
+        async for batch in batches:
+            for user_id in batch:
+                if hub.is_online(user_id):
+                    hub.send_to_user(user_id, event)
+                    self.deliveries += 1
+            self.batches += 1
+            await asyncio.sleep(0)
+
+        self.post_ms_max = max(self.post_ms_max, (time.perf_counter() - started) * 1000)
+
+    async def _run(self, session_factory):
+        while True:
+            chat_id, payload = await self._queue.get()
+            try:
+                await self.deliver(session_factory, chat_id, payload)
+            except Exception:
+                logger.exception(f"Failed to broadcast post in channel {chat_id}")
+
+    def start(self, session_factory):
+        """Start the delivery task."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run(session_factory))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._queue = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "posts": self.posts,
+            "batches": self.batches,
+            "deliveries": self.deliveries,
+            "post_ms_max": self.post_ms_max
+        }
+
+
+channel_broadcaster = ChannelBroadcaster()
+event_bus.on("channel_post", channel_broadcaster._enqueue)
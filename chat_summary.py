@@ -0,0 +1,82 @@
+"""Denormalized per-chat summary of the newest message.
+
+The chat list reads ``Chat.last_message_*`` instead of loading message
+history, so every write path that can change the newest message of a chat
+has to go through one of the helpers below.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select, update, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, Message
+
+PREVIEW_LENGTH = 100
+
+
+def make_preview(content: Optional[str]) -> Optional[str]:
+    """Shorten message content for the chat list."""
+    if content is None:
+        return None
+    return content[:PREVIEW_LENGTH]
+
+
+async def record_message(session: AsyncSession, message: Message):
+    """Point the chat summary at a newly inserted (flushed) message."""
+    await session.execute(
+        update(Chat)
+        .where(Chat.id == message.chat_id)
+        .values(
+            last_message_id=message.id,
+            last_message_preview=make_preview(message.content),
+            last_message_at=message.created_at,
+            last_message_sender_id=message.sender_id,
+            updated_at=message.created_at or datetime.utcnow()
+        )
+    )
+
+
+async def record_edit(session: AsyncSession, message: Message):
+    """Refresh the preview if the edited message is the chat's newest one."""
+    await session.execute(
+        update(Chat)
+        .where(Chat.id == message.chat_id)
+        .where(Chat.last_message_id == message.id)
+        .values(
+            last_message_preview=make_preview(message.content),
+            updated_at=Chat.updated_at  # an edit must not reorder the chat list
+        )
+    )
+
+
+async def record_delete(session: AsyncSession, chat_id: int, message_id: int):
+    """Fall back to the previous message if the newest one was deleted.
+
+    Must be called after the delete has been flushed. The lookup of the
+    previous message is skipped unless the deleted one was the newest.
+    """
+    chat = await session.get(Chat, chat_id)
+    if chat is None or chat.last_message_id != message_id:
+        return
+
+    result = await session.execute(
+        select(Message)
+        .where(Message.chat_id == chat_id)
+        .order_by(desc(Message.id))
+        .limit(1)
+    )
+    latest = result.scalar_one_or_none()
+
+    await session.execute(
+        update(Chat)
+        .where(Chat.id == chat_id)
+        .where(Chat.last_message_id == message_id)
+        .values(
+            last_message_id=latest.id if latest else None,
+            last_message_preview=make_preview(latest.content) if latest else None,
+            last_message_at=latest.created_at if latest else None,
+            last_message_sender_id=latest.sender_id if latest else None,
+            updated_at=Chat.updated_at
+        )
+    )
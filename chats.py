@@ -1,14 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc
-from sqlalchemy.orm import selectinload
-from typing import List
-from datetime import datetime
+from sqlalchemy import select, desc, delete, func
+from typing import List, Optional
 
 from main import async_session
-from models import User, Chat, Message, ChatType
+from models import User, Chat, ChatType, chat_members
 from schemas import ChatCreate, ChatResponse
-from dependencies import get_current_user, get_db
+from dependencies import get_current_user, get_db, get_read_db
+from read_state import read_cursors, unread_count
+from membership import membership_changed, is_member
+from write_pipeline import write_pipeline
+import update_log
 
 router = APIRouter()
 
@@ -16,39 +18,52 @@ router = APIRouter()
 @router.get("/", response_model=List[ChatResponse])
 async def get_chats(
     current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Get all chats for current user."""
+    """Get all chats for current user.
+    
+    Reads the denormalized last-message summary stored on each chat, so the
+    cost depends on the number of chats and not on their history.
+    """
     user_id = current_user["user_id"]
     
-    # Get user's chats
+    # Apply this user's buffered read cursors so unread counts are current
+    # (taken before the write, so that a batch retried op by op still has them)
+    pending = read_cursors.take(user_id)
+    if pending:
+        try:
+            await write_pipeline.submit(lambda session: read_cursors.write(session, pending))
+        except Exception:
+            read_cursors.restore(pending)
+            raise
+    
+    # Get user's chats with the user's read cursor (index ix_chat_members_user_id)
     result = await db.execute(
-        select(Chat)
-        .options(selectinload(Chat.members), selectinload(Chat.messages))
-        .where(Chat.members.any(id=user_id))
+        select(Chat, chat_members.c.read_seq, chat_members.c.last_read_message_id)
+        .join(chat_members, chat_members.c.chat_id == Chat.id)
+        .where(chat_members.c.user_id == user_id)
         .order_by(desc(Chat.updated_at))
     )
-    chats = result.scalars().all()
+    rows = result.all()
+    chats = [row.Chat for row in rows]
+    
+    # For private chats, show other member's name (one query for all of them)
+    private_titles = {}
+    private_ids = [chat.id for chat in chats if chat.type == ChatType.PRIVATE]
+    if private_ids:
+        title_result = await db.execute(
+            select(chat_members.c.chat_id, User.display_name)
+            .join(User, User.id == chat_members.c.user_id)
+            .where(chat_members.c.chat_id.in_(private_ids))
+            .where(chat_members.c.user_id != user_id)
+        )
+        for chat_id, display_name in title_result:
+            private_titles.setdefault(chat_id, display_name)
     
     response = []
-    for chat in chats:
-        # Get last message
-        last_msg = chat.messages[0] if chat.messages else None
-        
-        # Count unread messages (messages after last read)
-        unread_result = await db.execute(
-            select(Message)
-            .where(Message.chat_id == chat.id)
-            .where(Message.sender_id != user_id)
-            .where(Message.created_at > (current_user.get("last_seen", datetime.min)))
-        )
-        unread_count = len(unread_result.scalars().all())
-        
-        # Determine chat title
+    for chat, read_seq, last_read_message_id in rows:
         if chat.type == ChatType.PRIVATE:
-            # For private chats, show other member's name
-            other_member = [m for m in chat.members if m.id != user_id]
-            title = other_member[0].display_name if other_member else "Unknown"
+            title = private_titles.get(chat.id, "Unknown")
         else:
             title = chat.title
         
@@ -59,9 +74,12 @@ async def get_chats(
             "avatar_url": chat.avatar_url,
             "owner_id": chat.owner_id,
             "created_at": chat.created_at,
-            "last_message": last_msg.content if last_msg else None,
-            "last_message_time": last_msg.created_at if last_msg else None,
-            "unread_count": unread_count
+            "last_message": chat.last_message_preview,
+            "last_message_time": chat.last_message_at,
+            "last_message_id": chat.last_message_id,
+            "last_message_sender_id": chat.last_message_sender_id,
+            "last_read_message_id": last_read_message_id,
+            "unread_count": unread_count(chat.message_seq, read_seq)
         })
     
     return response
@@ -76,28 +94,32 @@ async def create_chat(
     """Create a new chat."""
     user_id = current_user["user_id"]
     
+    # Owner and other members (one query, duplicates dropped)
+    member_ids = {user_id, *chat_data.member_ids}
+    members_result = await db.execute(select(User).where(User.id.in_(member_ids)))
+    members = members_result.scalars().all()
+    if user_id not in {m.id for m in members}:
+        raise HTTPException(status_code=404, detail="User not found")
+    
     chat = Chat(
         title=chat_data.title,
         type=ChatType(chat_data.type.value) if isinstance(chat_data.type, str) else chat_data.type,
-        owner_id=user_id
+        owner_id=user_id,
+        members=list(members)
     )
-    
-    # Add owner as member
-    owner_result = await db.execute(select(User).where(User.id == user_id))
-    owner = owner_result.scalar_one()
-    chat.members.append(owner)
-    
-    # Add other members
-    for member_id in chat_data.member_ids:
-        member_result = await db.execute(select(User).where(User.id == member_id))
-        member = member_result.scalar_one_or_none()
-        if member:
-            chat.members.append(member)
-    
     db.add(chat)
+    await db.flush()
+    
+    recorded = await update_log.record(db, [m.id for m in members], {
+        "type": "chat_joined",
+        "chat_id": chat.id
+    }, chat_id=chat.id)
     await db.commit()
     await db.refresh(chat)
     
+    membership_changed(chat.id, [m.id for m in members])
+    update_log.push(recorded)
+    
     return {
         "id": chat.id,
         "title": chat.title,
@@ -117,29 +139,70 @@ async def get_chat(
     current_user: dict = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get chat by ID."""
+    """Get chat by ID.
+    
+    Channels report their subscriber count instead of listing every member.
+    """
     user_id = current_user["user_id"]
     
-    result = await db.execute(
-        select(Chat)
-        .options(selectinload(Chat.members))
-        .where(Chat.id == chat_id)
-    )
-    chat = result.scalar_one_or_none()
+    chat = await db.get(Chat, chat_id)
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
     # Check if user is member
-    if user_id not in [m.id for m in chat.members]:
+    if not await is_member(db, chat_id, user_id):
         raise HTTPException(status_code=403, detail="Not a member of this chat")
     
-    return {
+    response = {
         "id": chat.id,
         "title": chat.title if chat.type != ChatType.PRIVATE else "Chat",
-        "type": chat.type.value,
-        "members": [{"id": m.id, "username": m.username, "display_name": m.display_name} for m in chat.members]
+        "type": chat.type.value
     }
+    if chat.type == ChatType.CHANNEL:
+        count_result = await db.execute(
+            select(func.count()).select_from(chat_members).where(chat_members.c.chat_id == chat_id)
+        )
+        response["member_count"] = count_result.scalar_one()
+        return response
+    
+    members_result = await db.execute(
+        select(User)
+        .join(chat_members, chat_members.c.user_id == User.id)
+        .where(chat_members.c.chat_id == chat_id)
+    )
+    response["members"] = [
+        {"id": m.id, "username": m.username, "display_name": m.display_name}
+        for m in members_result.scalars()
+    ]
+    return response
+
+
+@router.post("/{chat_id}/read")
+async def mark_chat_read(
+    chat_id: int,
+    message_id: Optional[int] = None,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Advance the read cursor (defaults to the newest message).
+    
+    The cursor is written with the next batched flush.
+    """
+    user_id = current_user["user_id"]
+    
+    if not await is_member(db, chat_id, user_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    if message_id is None:
+        result = await db.execute(
+            select(Chat.last_message_id).where(Chat.id == chat_id)
+        )
+        message_id = result.scalar_one_or_none()
+    if message_id is not None:
+        read_cursors.advance(chat_id, user_id, message_id)
+    
+    return {"chat_id": chat_id, "last_read_message_id": message_id}
 
 
 @router.post("/{chat_id}/leave")
@@ -152,16 +215,22 @@ async def leave_chat(
     user_id = current_user["user_id"]
     
     result = await db.execute(
-        select(Chat).where(Chat.id == chat_id)
+        select(Chat.id).where(Chat.id == chat_id)
     )
-    chat = result.scalar_one_or_none()
-    
-    if not chat:
+    if result.first() is None:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    member = next((m for m in chat.members if m.id == user_id), None)
-    if member:
-        chat.members.remove(member)
-        await db.commit()
+    await db.execute(
+        delete(chat_members)
+        .where(chat_members.c.chat_id == chat_id)
+        .where(chat_members.c.user_id == user_id)
+    )
+    recorded = await update_log.record(db, [user_id], {
+        "type": "chat_left",
+        "chat_id": chat_id
+    }, chat_id=chat_id)
+    await db.commit()
+    membership_changed(chat_id, [user_id])
+    update_log.push(recorded)
     
     return {"message": "Left chat successfully"}
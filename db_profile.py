@@ -0,0 +1,60 @@
+"""SQLite connection profiles.
+
+``default`` keeps SQLAlchemy's defaults: one engine, a new connection per
+session, rollback journal. ``production`` switches the database to WAL,
+applies the pragmas below on every connection and splits connections into
+a single write connection and a pool of read-only connections, so readers
+and the writer no longer block each other.
+"""
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from settings import Config
+
+PROFILES = ("default", "production")
+
+
+def is_production() -> bool:
+    if Config.DATABASE_PROFILE not in PROFILES:
+        raise ValueError(f"Unknown DATABASE_PROFILE: {Config.DATABASE_PROFILE}")
+    return Config.DATABASE_PROFILE == "production"
+
+
+def connection_pragmas(read_only: bool = False) -> list:
+    """Pragmas run on every new connection in the production profile."""
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA mmap_size={Config.SQLITE_MMAP_SIZE}",
+        f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KB}",  # negative = KiB
+        "PRAGMA temp_store=MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+
+def engine_options(read_only: bool = False) -> dict:
+    """Keyword arguments for create_async_engine."""
+    if not is_production():
+        return {}
+    return {
+        "poolclass": AsyncAdaptedQueuePool,
+        "pool_size": Config.DATABASE_READ_POOL_SIZE if read_only else 1,
+        "max_overflow": 0,
+    }
+
+
+def install_pragmas(engine, read_only: bool = False):
+    """Run the profile's pragmas whenever the engine opens a connection."""
+    if not is_production():
+        return
+    pragmas = connection_pragmas(read_only)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
@@ -1,13 +1,12 @@
-from typing import Generator
-from sqlalchemy.ext.asyncio import AsyncSession
-from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
-from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Generator, Optional
+from fastapi import Depends, HTTPException, WebSocket, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
-from settings import Config
-from auth import get_user_by_username
-from main import async_session
-from schemas import TokenData
+from main import async_session, async_read_session
+from token_auth import InvalidToken, token_verifier
+
+# Missing credentials are a 401 here rather than HTTPBearer's 403
+bearer_scheme = HTTPBearer(auto_error=False)
 
 async def get_db() -> Generator:
     """Get database session."""
@@ -21,24 +20,48 @@ async def get_db() -> Generator:
         finally:
             await session.close()
 
-async def get_current_user(token: str = Depends(lambda x: x.headers.get("Authorization", "").replace("Bearer ", ""))) -> dict:
-    """Get current user from JWT token."""
-    credentials_exception = HTTPException(
+async def get_read_db() -> Generator:
+    """Get a database session for endpoints that only read.
+    
+    Uses the read-only connection pool in the production profile.
+    """
+    async with async_read_session() as session:
+        yield session
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+async def get_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> str:
+    """The bearer token of the request."""
+    if credentials is None:
+        raise _credentials_exception()
+    return credentials.credentials
+
+async def get_current_user(token: str = Depends(get_token)) -> dict:
+    """Get current user from JWT token.
     
+    Verified tokens are cached, see token_auth.py.
+    """
     try:
-        payload = jwt.decode(token, Config.SECRET_KEY, algorithms=[Config.ALGORITHM])
-        username: str = payload.get("sub")
-        user_id: int = payload.get("user_id")
-        
-        if username is None:
-            raise credentials_exception
-        
-        token_data = TokenData(username=username, user_id=user_id)
-    except JWTError:
-        raise credentials_exception
+        return token_verifier.verify(token)
+    except InvalidToken:
+        raise _credentials_exception()
+
+def websocket_principal(websocket: WebSocket, token: Optional[str]) -> Optional[dict]:
+    """The user of a WebSocket handshake, or None.
     
-    return {"username": token_data.username, "user_id": token_data.user_id}
+    Browsers cannot set headers on a WebSocket, so the token may come as the
+    `token` query parameter as well as an Authorization header.
+    """
+    if token is None:
+        scheme, _, token = websocket.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            return None
+    try:
+        return token_verifier.verify(token)
+    except InvalidToken:
+        return None
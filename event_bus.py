@@ -0,0 +1,413 @@
+"""Pub/sub bus for realtime events across uvicorn workers.
+
+Every worker owns its sockets (``ws_hub.hub``) and only ever delivers to
+them. Events meant for users are published on the bus and each worker
+hands them to its own connections. The bus also reports on which workers
+each user is online to ``presence_store``, so ``/ws/online`` and presence
+notifications reflect the whole cluster: a user goes offline once their
+last socket on any worker closes.
+
+Backends (``Config.EVENT_BUS_BACKEND``):
+
+- ``inprocess``: single worker, events are delivered directly
+- ``unix``: workers on one host exchange datagrams over Unix domain
+  sockets in ``Config.EVENT_BUS_DIR`` (one socket per worker)
+
+Run several workers with the ``unix`` backend selected in the environment,
+which every worker reads:
+
+    LIIME_EVENT_BUS=unix uvicorn main:app --workers 4
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Iterable, Optional
+
+from settings import Config
+from ws_hub import hub, OutboundEvent, SequencedEvent
+from presence import presence_notifier
+from presence_store import presence_store
+
+logger = logging.getLogger(__name__)
+
+# First byte of a fragment datagram (whole messages are JSON objects), then
+# fragment id, index, count and the length of the sender's worker id
+FRAGMENT = b"\x00"
+_FRAGMENT_HEADER = struct.Struct(">IHHB")
+
+
+class EventBus:
+    """In-process bus; also the base class for multi-worker backends."""
+
+    def __init__(self):
+        self.worker_id = str(os.getpid())
+        self._handlers: Dict[str, Callable[[dict], None]] = {}
+        # Stats
+        self.published = 0
+        self.received = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def on(self, kind: str, handler: Callable[[dict], None]):
+        """Register the handler for a kind of control event."""
+        self._handlers[kind] = handler
+
+    def publish(self, kind: str, data: dict):
+        """Run a control event's handler on every worker, this one included."""
+        self._dispatch(kind, data)
+        self._send_all({"k": kind, "d": data})
+
+    def publish_to_users(self, user_ids: Iterable[int], payload: dict,
+                         coalesce_key: Optional[Hashable] = None,
+                         seqs: Optional[Dict[int, int]] = None):
+        """Deliver an event to every live socket of the given users.
+
+        `seqs` gives each user's own ``seq`` for their copy of the event,
+        which is still serialized once (see ``SequencedEvent``).
+        """
+        event = OutboundEvent(payload, coalesce_key)
+        remote: Dict[str, list] = {}
+        for user_id in user_ids:
+            for worker_id in presence_store.workers(user_id):
+                if worker_id == self.worker_id:
+                    hub.send_to_user(user_id, event if seqs is None else SequencedEvent(event, seqs[user_id]))
+                else:
+                    remote.setdefault(worker_id, []).append(user_id)
+        self.published += 1
+        for worker_id, ids in remote.items():
+            message = {
+                "k": "deliver",
+                "u": ids,
+                "p": payload,
+                "c": list(coalesce_key) if coalesce_key is not None else None
+            }
+            if seqs is not None:
+                message["q"] = [seqs[user_id] for user_id in ids]
+            self._send(worker_id, message)
+
+    def set_local_presence(self, user_id: int, is_online: bool):
+        """Record that a user's first socket opened / last socket closed here."""
+        self._apply_presence(self.worker_id, user_id, is_online)
+        self._send_all({"k": "presence", "w": self.worker_id, "u": user_id, "o": is_online})
+
+    def _apply_presence(self, worker_id: str, user_id: int, is_online: bool, write: Optional[bool] = None):
+        # The worker whose socket it was writes the change back
+        if write is None:
+            write = worker_id == self.worker_id
+        if presence_store.set_socket_presence(worker_id, user_id, is_online, write):
+            # Every worker sees the transition and notifies its own sockets
+            presence_notifier.status_changed(user_id, is_online)
+
+    def _forget_worker(self, worker_id: str):
+        """Drop the presence contributed by a worker that went away."""
+        for user_id in presence_store.local_user_ids(worker_id):
+            # It cannot write its users back any more
+            self._apply_presence(worker_id, user_id, False, write=True)
+
+    def _dispatch(self, kind: str, data: dict):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning(f"No handler for bus event {kind}")
+            return
+        try:
+            handler(data)
+        except Exception:
+            logger.exception(f"Bus handler for {kind} failed")
+
+    def _receive(self, message: dict):
+        """Handle a message from another worker."""
+        self.received += 1
+        kind = message["k"]
+        if kind == "deliver":
+            key = message["c"]
+            event = OutboundEvent(message["p"], tuple(key) if key else None)
+            seqs = message.get("q")
+            if seqs is None:
+                hub.send_to_users(message["u"], event)
+            else:
+                for user_id, seq in zip(message["u"], seqs):
+                    hub.send_to_user(user_id, SequencedEvent(event, seq))
+        elif kind == "presence":
+            self._apply_presence(message["w"], message["u"], message["o"])
+        else:
+            self._dispatch(kind, message["d"])
+
+    # Transport, overridden by multi-worker backends
+
+    def _send(self, worker_id: str, message: dict):
+        pass
+
+    def _send_all(self, message: dict):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "backend": Config.EVENT_BUS_BACKEND,
+            "worker_id": self.worker_id,
+            "published": self.published,
+            "received": self.received
+        }
+
+
+class UnixSocketBus(EventBus):
+    """Workers on one host exchanging datagrams over Unix domain sockets.
+
+    Each worker binds ``<EVENT_BUS_DIR>/<pid>.sock``; peers are discovered
+    by listing the directory. A newly started worker says hello and peers
+    answer with the users online on them. A peer that stops answering
+    heartbeats, or whose socket refuses datagrams, is dropped along with
+    its presence. Peers also send the statuses users declared over HTTP
+    (``POST /api/users/online``), which every worker holds.
+
+    Messages larger than ``Config.EVENT_BUS_MAX_DATAGRAM`` are sent as
+    fragments and reassembled by the peer. When a peer's receive buffer is
+    full, datagrams for it wait in order in a backlog (at most
+    ``Config.EVENT_BUS_BACKLOG``) that a task retries until it drains.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(str(directory), f"{self.worker_id}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._transport = None
+        self._peers: Dict[str, float] = {}  # worker_id -> last heard from
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._backlogs: Dict[str, deque] = {}  # worker_id -> datagrams waiting for room
+        self._partial: Dict[tuple, list] = {}  # (worker_id, fragment id) -> [received at, parts]
+        self._next_fragment_id = 0
+        self.send_errors = 0
+        self.fragmented = 0
+        self.backlogged = 0
+        self.dropped = 0
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        bus = self
+
+        class _Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if data[:1] == FRAGMENT:
+                    data = bus._reassemble(data)
+                    if data is None:
+                        return
+                try:
+                    message = json.loads(data)
+                except ValueError:
+                    return
+                bus._heard_from(message.get("w"), message.get("k"))
+                bus._receive(message)
+
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.path)
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            _Protocol, sock=receiver
+        )
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+        self._discover_peers()
+        self._send_all({"k": "hello"})
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f"Event bus worker {self.worker_id} listening on {self.path}")
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self._sock is not None:
+            self._send_all({"k": "bye"})
+            self._sock.close()
+            self._sock = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _receive(self, message: dict):
+        kind = message["k"]
+        sender = message.get("w")
+        if kind == "hello":
+            # Tell the new worker who is online here, and who declared
+            # themselves online before it started
+            local = presence_store.local_user_ids(self.worker_id)
+            declared = presence_store.declared_user_ids()
+            self._send(sender, {"k": "snapshot", "u": local, "d": declared})
+        elif kind == "snapshot":
+            for user_id in message["u"]:
+                self._apply_presence(sender, user_id, True)
+            for user_id in message.get("d", ()):
+                # The worker that took the declaration writes it back
+                if presence_store.declare(user_id, True, write=False):
+                    presence_notifier.status_changed(user_id, True)
+        elif kind == "bye":
+            self._drop_peer(sender)
+        elif kind != "ping":
+            super()._receive(message)
+
+    def _heard_from(self, worker_id: Optional[str], kind: str):
+        if not worker_id or worker_id == self.worker_id:
+            return
+        if worker_id not in self._peers and kind != "hello":
+            # A peer we had dropped (e.g. its loop stalled): ask for its state again
+            self._peers[worker_id] = time.monotonic()
+            self._send(worker_id, {"k": "hello"})
+        self._peers[worker_id] = time.monotonic()
+
+    def _discover_peers(self):
+        now = time.monotonic()
+        for name in os.listdir(self.directory):
+            worker_id, ext = os.path.splitext(name)
+            if ext == ".sock" and worker_id != self.worker_id:
+                self._peers.setdefault(worker_id, now)
+
+    def _drop_peer(self, worker_id: str):
+        if self._peers.pop(worker_id, None) is not None:
+            logger.info(f"Event bus peer {worker_id} is gone")
+        self._backlogs.pop(worker_id, None)
+        for key in [key for key in self._partial if key[0] == worker_id]:
+            del self._partial[key]
+        self._forget_worker(worker_id)
+
+    async def _heartbeat(self):
+        interval = Config.EVENT_BUS_HEARTBEAT_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            self._discover_peers()
+            self._send_all({"k": "ping"})
+            deadline = time.monotonic() - 3 * interval
+            for worker_id, last_seen in list(self._peers.items()):
+                if last_seen < deadline:
+                    self._drop_peer(worker_id)
+            for key in [key for key, (received, _) in self._partial.items() if received < deadline]:
+                del self._partial[key]
+
+    def _send(self, worker_id: str, message: dict):
+        if self._sock is None:
+            return
+        message["w"] = self.worker_id
+        data = json.dumps(message, default=str).encode()
+        if len(data) <= Config.EVENT_BUS_MAX_DATAGRAM:
+            self._send_datagram(worker_id, data)
+            return
+        self.fragmented += 1
+        for fragment in self._fragments(data):
+            self._send_datagram(worker_id, fragment)
+
+    def _fragments(self, data: bytes) -> list:
+        """Split an encoded message into fragment datagrams."""
+        fragment_id = self._next_fragment_id
+        self._next_fragment_id = (fragment_id + 1) % 2**32
+        worker = self.worker_id.encode()
+        size = Config.EVENT_BUS_MAX_DATAGRAM - len(FRAGMENT) - _FRAGMENT_HEADER.size - len(worker)
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        return [
+            FRAGMENT + _FRAGMENT_HEADER.pack(fragment_id, index, len(chunks), len(worker)) + worker + chunk
+            for index, chunk in enumerate(chunks)
+        ]
+
+    def _reassemble(self, datagram: bytes) -> Optional[bytes]:
+        """Collect a fragment; the whole message once it is complete."""
+        fragment_id, index, count, worker_length = _FRAGMENT_HEADER.unpack_from(datagram, 1)
+        start = 1 + _FRAGMENT_HEADER.size
+        key = (datagram[start:start + worker_length].decode(), fragment_id)
+        received, parts = self._partial.setdefault(key, [time.monotonic(), {}])
+        parts[index] = datagram[start + worker_length:]
+        if len(parts) < count:
+            return None
+        del self._partial[key]
+        return b"".join(parts[i] for i in range(count))
+
+    def _send_datagram(self, worker_id: str, data: bytes):
+        backlog = self._backlogs.get(worker_id)
+        if backlog is not None:
+            # Keep the order: wait behind what is already waiting
+            if len(backlog) >= Config.EVENT_BUS_BACKLOG:
+                self.dropped += 1
+                logger.error(f"Event bus backlog for {worker_id} is full, message dropped")
+                return
+            backlog.append(data)
+            return
+        path = os.path.join(str(self.directory), f"{worker_id}.sock")
+        try:
+            self._sock.sendto(data, path)
+        except BlockingIOError:
+            # Peer's receive buffer is full
+            self.backlogged += 1
+            self._backlogs[worker_id] = deque([data])
+            asyncio.get_running_loop().create_task(self._drain(worker_id, path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._peer_vanished(worker_id, path)
+        except OSError as e:
+            self.send_errors += 1
+            logger.warning(f"Event bus send to {worker_id} failed: {e}")
+
+    async def _drain(self, worker_id: str, path: str):
+        """Send a peer's backlog as its buffer frees up."""
+        backlog = self._backlogs[worker_id]
+        delay = 0.001
+        try:
+            while backlog and self._sock is not None and self._backlogs.get(worker_id) is backlog:
+                try:
+                    self._sock.sendto(backlog[0], path)
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+                    continue
+                backlog.popleft()
+                delay = 0.001
+        except (ConnectionRefusedError, FileNotFoundError):
+            self._peer_vanished(worker_id, path)
+        except OSError as e:
+            self.send_errors += 1
+            logger.warning(f"Event bus send to {worker_id} failed: {e}")
+        finally:
+            if self._backlogs.get(worker_id) is backlog:
+                del self._backlogs[worker_id]
+
+    def _peer_vanished(self, worker_id: str, path: str):
+        # Stale socket of a worker that died without saying bye
+        self._drop_peer(worker_id)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _send_all(self, message: dict):
+        for worker_id in list(self._peers):
+            self._send(worker_id, dict(message))
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["peers"] = len(self._peers)
+        stats["send_errors"] = self.send_errors
+        stats["fragmented"] = self.fragmented
+        stats["backlogged"] = self.backlogged
+        stats["backlog"] = sum(len(backlog) for backlog in self._backlogs.values())
+        stats["dropped"] = self.dropped
+        return stats
+
+
+def create_bus() -> EventBus:
+    if Config.EVENT_BUS_BACKEND == "inprocess":
+        return EventBus()
+    if Config.EVENT_BUS_BACKEND == "unix":
+        return UnixSocketBus(Config.EVENT_BUS_DIR)
+    raise ValueError(f"Unknown EVENT_BUS_BACKEND: {Config.EVENT_BUS_BACKEND}")
+
+
+event_bus = create_bus()
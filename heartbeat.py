@@ -0,0 +1,136 @@
+"""Application-level WebSocket heartbeat.
+
+Every connection has one entry in a hashed timer wheel: ``WHEEL_SIZE``
+slots, one per ``Config.WS_HEARTBEAT_TICK`` seconds, with a round counter
+for deadlines further away than one turn; both are stored on the
+connection record itself. Scheduling and cancelling are O(1), and a single
+task advances the wheel instead of one sleeping task per connection.
+
+When a connection's entry fires, a connection that has been silent for
+``Config.WS_HEARTBEAT_INTERVAL`` seconds gets a ``ping`` frame (any frame
+from the client counts as an answer), and one silent for
+``Config.WS_PING_TIMEOUT`` seconds is reaped: the handler registered with
+``on_reap`` unregisters it (updating presence) and the socket is closed.
+"""
+import asyncio
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional
+
+from settings import Config
+from ws_hub import Connection, OutboundEvent
+
+logger = logging.getLogger(__name__)
+
+WHEEL_SIZE = 64
+
+PING = OutboundEvent({"type": "ping"})
+
+
+class HeartbeatWheel:
+    """Hashed timer wheel driving pings and the idle-connection reaper."""
+
+    def __init__(self, tick: float, size: int = WHEEL_SIZE):
+        self.tick = tick
+        self.size = size
+        self._slots: List[Dict[int, Connection]] = [{} for _ in range(size)]  # conn_id -> connection
+        self.watched = 0
+        self._cursor = 0  # next tick to process
+        self._on_reap: Optional[Callable[[Connection], None]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Stats
+        self.pings_sent = 0
+        self.reaped = 0
+        self.lag_ms_last = 0.0
+        self.lag_ms_max = 0.0
+
+    def on_reap(self, handler: Callable[[Connection], None]):
+        """Register the function that unregisters a reaped connection."""
+        self._on_reap = handler
+
+    def add(self, conn: Connection):
+        """Start watching a connection."""
+        self._schedule(conn, Config.WS_HEARTBEAT_INTERVAL)
+
+    def remove(self, conn: Connection):
+        if conn.hb_slot >= 0:
+            del self._slots[conn.hb_slot][conn.conn_id]
+            conn.hb_slot = -1
+            self.watched -= 1
+
+    def _schedule(self, conn: Connection, delay: float):
+        self.remove(conn)
+        ticks = max(1, math.ceil(delay / self.tick))
+        conn.hb_slot = (self._cursor + ticks - 1) % self.size
+        conn.hb_rounds = (ticks - 1) // self.size
+        self._slots[conn.hb_slot][conn.conn_id] = conn
+        self.watched += 1
+
+    def _process_slot(self, now: float):
+        slot = self._cursor % self.size
+        entries = self._slots[slot]
+        due = []
+        for conn in list(entries.values()):
+            if conn.hb_rounds:
+                conn.hb_rounds -= 1
+            else:
+                self.remove(conn)
+                due.append(conn)
+        self._cursor += 1
+
+        for conn in due:
+            idle = now - conn.last_seen
+            if idle >= Config.WS_PING_TIMEOUT:
+                self._reap(conn)
+            elif idle >= Config.WS_HEARTBEAT_INTERVAL:
+                conn.send(PING)
+                self.pings_sent += 1
+                self._schedule(conn, min(Config.WS_HEARTBEAT_INTERVAL, Config.WS_PING_TIMEOUT - idle))
+            else:
+                self._schedule(conn, Config.WS_HEARTBEAT_INTERVAL - idle)
+
+    def _reap(self, conn: Connection):
+        self.reaped += 1
+        logger.info(f"Reaping idle connection {conn.user_id}/{conn.conn_id}")
+        if self._on_reap is not None:
+            try:
+                self._on_reap(conn)
+            except Exception:
+                logger.exception("Reap handler failed")
+        asyncio.create_task(conn.close(code=1001))  # going away
+
+    async def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            now = time.monotonic()
+            lag = (now - next_tick) * 1000
+            self.lag_ms_last = lag
+            self.lag_ms_max = max(self.lag_ms_max, lag)
+            # Catch up on every tick missed while the loop was busy
+            while next_tick <= now:
+                self._process_slot(now)
+                next_tick += self.tick
+
+    def start(self):
+        """Start the wheel task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "watched": self.watched,
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped,
+            "lag_ms_last": self.lag_ms_last,
+            "lag_ms_max": self.lag_ms_max
+        }
+
+
+heartbeat = HeartbeatWheel(Config.WS_HEARTBEAT_TICK)
@@ -17,6 +17,18 @@ from sqlalchemy.orm import sessionmaker
 
 from settings import Config
 from models import Base
+from migrations import run_migrations, schema_lock
+from db_profile import engine_options, install_pragmas, is_production
+from read_state import read_cursors
+from write_pipeline import write_pipeline
+from presence import presence_notifier
+from presence_store import presence_store
+from typing_state import typing_notifier
+from event_bus import event_bus
+from heartbeat import heartbeat
+from channel_broadcast import channel_broadcaster
+from token_auth import token_verifier
+from password_hashing import password_hasher
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -28,8 +40,10 @@ DATABASE_URL = f"sqlite+aiosqlite:///{Config.DATABASE_PATH}"
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False},
+    **engine_options()
 )
+install_pragmas(engine)
 
 async_session = sessionmaker(
     engine, 
@@ -37,24 +51,65 @@ async_session = sessionmaker(
     expire_on_commit=False
 )
 
+# Read-only endpoints use a separate pool in the production profile
+if is_production():
+    read_engine = create_async_engine(
+        DATABASE_URL,
+        echo=False,
+        connect_args={"check_same_thread": False},
+        **engine_options(read_only=True)
+    )
+    install_pragmas(read_engine, read_only=True)
+else:
+    read_engine = engine
+
+async_read_session = sessionmaker(
+    read_engine,
+    class_=AsyncSession,
+    expire_on_commit=False
+)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown events."""
     # Startup
     logger.info("Starting Liime Server...")
     
-    # Create tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Create tables, one worker at a time (the lock waits for the commit)
+    with schema_lock(Config.DATABASE_PATH):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(run_migrations)
+    
+    logger.info(f"Database tables created (profile: {Config.DATABASE_PROFILE})")
     
-    logger.info("Database tables created")
+    await token_verifier.start(async_session)
+    write_pipeline.start(async_session)
+    read_cursors.start(async_session)
+    presence_store.start(async_session)
+    presence_notifier.start(async_read_session)
+    typing_notifier.start(async_read_session)
+    heartbeat.start()
+    channel_broadcaster.start(async_read_session)
+    await event_bus.start()
     logger.info(f"Server started at http://{Config.HOST}:{Config.PORT}")
     
     yield
     
     # Shutdown
     logger.info("Shutting down Liime Server...")
+    await event_bus.stop()
+    channel_broadcaster.stop()
+    heartbeat.stop()
+    typing_notifier.stop()
+    presence_notifier.stop()
+    await presence_store.stop(async_session)
+    await read_cursors.stop(async_session)
+    await write_pipeline.stop()
+    password_hasher.stop()
     await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
 
 # Create FastAPI app
 app = FastAPI(
@@ -71,6 +126,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Older-Cursor", "X-Newer-Cursor", "X-Next-Cursor", "Deprecation", "ETag"],
 )
 
 # Import and include routers
@@ -79,12 +135,14 @@ from auth_router import router as auth_router
 from chats import router as chats_router
 from messages import router as messages_router
 from users import router as users_router
+from updates import router as updates_router
 from ws_handler import router as ws_router
 
 app.include_router(auth_router, prefix="/api/auth", tags=["Auth"])
 app.include_router(users_router, prefix="/api/users", tags=["Users"])
 app.include_router(chats_router, prefix="/api/chats", tags=["Chats"])
 app.include_router(messages_router, prefix="/api/messages", tags=["Messages"])
+app.include_router(updates_router, prefix="/api/updates", tags=["Updates"])
 app.include_router(api_router)
 app.include_router(ws_router, prefix="/ws", tags=["WebSocket"])
 
@@ -104,4 +162,5 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host=Config.HOST, port=Config.PORT)
+    uvicorn.run(app, host=Config.HOST, port=Config.PORT,
+                ws_per_message_deflate=Config.WS_PER_MESSAGE_DEFLATE)
@@ -1,5 +1,19 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+from dependencies import get_current_user
 from schemas import UserResponse, ChatResponse, MessageResponse
+from membership import membership_cache
+from write_pipeline import write_pipeline
+from ws_hub import hub
+from presence import presence_notifier
+from presence_store import presence_store
+from typing_state import typing_notifier
+from event_bus import event_bus
+from heartbeat import heartbeat
+from channel_broadcast import channel_broadcaster
+from message_cache import message_cache
+from token_auth import token_verifier
+from password_hashing import password_hasher
+from user_cache import user_cache
 
 router = APIRouter()
 
@@ -10,3 +24,22 @@ async def get_status():
 @router.get("/api/test")
 async def test_endpoint():
     return {"message": "Server is working!", "status": "ok"}
+
+@router.get("/api/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    """Counters of the caches, queues and connections (signed-in users only)."""
+    return {
+        "membership_cache": membership_cache.stats(),
+        "write_pipeline": write_pipeline.stats(),
+        "message_cache": message_cache.stats(),
+        "token_cache": token_verifier.stats(),
+        "password_hashing": password_hasher.stats(),
+        "user_cache": user_cache.stats(),
+        "ws_hub": hub.stats(),
+        "heartbeat": heartbeat.stats(),
+        "presence": presence_notifier.stats(),
+        "presence_store": presence_store.stats(),
+        "typing": typing_notifier.stats(),
+        "channels": channel_broadcaster.stats(),
+        "event_bus": event_bus.stats()
+    }
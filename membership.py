@@ -0,0 +1,94 @@
+"""Chat membership checks.
+
+A membership check is a point lookup on the ``chat_members`` primary key
+(chat_id, user_id), fronted by a bounded in-process LRU cache. Code that
+changes membership must call ``membership_changed``, which invalidates the
+cache on every worker.
+"""
+from collections import OrderedDict
+from typing import Iterable, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import chat_members
+from settings import Config
+from event_bus import event_bus
+from presence import presence_notifier
+
+
+class MembershipCache:
+    """LRU cache of (chat_id, user_id) -> is member, with hit/miss counters."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, int], bool]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, user_id: int):
+        """Cached answer, or None if unknown."""
+        key = (chat_id, user_id)
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, chat_id: int, user_id: int, is_member: bool):
+        key = (chat_id, user_id)
+        self._entries[key] = is_member
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int, user_id: int):
+        self._entries.pop((chat_id, user_id), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+membership_cache = MembershipCache(Config.MEMBERSHIP_CACHE_SIZE)
+
+
+def _on_membership_changed(data: dict):
+    for user_id in data["user_ids"]:
+        membership_cache.invalidate(data["chat_id"], user_id)
+    presence_notifier.invalidate_contacts(data["user_ids"])
+
+
+event_bus.on("membership_changed", _on_membership_changed)
+
+
+def membership_changed(chat_id: int, user_ids: Iterable[int]):
+    """Drop cached membership (and presence contacts) on every worker."""
+    event_bus.publish("membership_changed", {"chat_id": chat_id, "user_ids": list(user_ids)})
+
+
+async def is_member(session: AsyncSession, chat_id: int, user_id: int) -> bool:
+    """Check whether a user belongs to a chat."""
+    cached = membership_cache.get(chat_id, user_id)
+    if cached is not None:
+        return cached
+
+    result = await session.execute(
+        select(chat_members.c.user_id)
+        .where(chat_members.c.chat_id == chat_id)
+        .where(chat_members.c.user_id == user_id)
+    )
+    found = result.first() is not None
+    membership_cache.put(chat_id, user_id, found)
+    return found
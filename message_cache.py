@@ -0,0 +1,264 @@
+"""In-memory ring buffers of the newest messages of hot chats.
+
+The first page of ``GET /api/messages/{chat_id}`` is served from here when
+possible. Each cached chat keeps its newest ``Config.MESSAGE_CACHE_PER_CHAT``
+messages, already serialized as response dicts, plus whether older messages
+exist. Chats are evicted least recently used first once the estimated size
+of all rings exceeds ``Config.MESSAGE_CACHE_MAX_BYTES``.
+
+A ring is filled from the database when a first page misses and is kept
+current by the write paths (``append``, ``edit``, ``delete`` after their
+commit). Writes to a chat while a fill is in flight discard that fill, so a
+page read before a write never overwrites the newer state.
+
+Every worker has its own cache, so each write is also published on the
+event bus: other workers drop the chat's ring (and any fill in flight),
+or replay status and display name changes, which name no chat.
+"""
+import bisect
+import sys
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from settings import Config
+from event_bus import event_bus
+
+# Rough per-message overhead of the dict, its keys and boxed values
+MESSAGE_OVERHEAD = 600
+
+
+def reply_preview(content: Optional[str]) -> Optional[str]:
+    """Shortened content of a replied-to message, as shown in history."""
+    if content is None:
+        return None
+    return content[:50] + "..." if len(content) > 50 else content
+
+
+def serialize(message, sender_name: str, reply_to_content: Optional[str]) -> dict:
+    """Response dict of a message (see schemas.MessageResponse)."""
+    return {
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "sender_id": message.sender_id,
+        "sender_name": sender_name,
+        "content": message.content,
+        "content_type": message.content_type,
+        "status": message.status.value if hasattr(message.status, 'value') else str(message.status),
+        "reply_to_id": message.reply_to_id,
+        "reply_to_content": reply_to_content,
+        "created_at": message.created_at,
+        "is_edited": message.is_edited
+    }
+
+
+def _size(entry: dict) -> int:
+    return MESSAGE_OVERHEAD + sys.getsizeof(entry["content"] or "") + sys.getsizeof(entry["reply_to_content"] or "")
+
+
+class ChatRing:
+    """Newest messages of one chat, oldest first."""
+
+    __slots__ = ("messages", "ids", "has_older", "size")
+
+    def __init__(self, messages: List[dict], has_older: bool):
+        self.messages = messages
+        self.ids = [m["id"] for m in messages]
+        self.has_older = has_older
+        self.size = sum(_size(m) for m in messages)
+
+
+class MessageCache:
+    """LRU of per-chat message rings under a global memory budget."""
+
+    def __init__(self, per_chat: int, max_bytes: int):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self._rings: "OrderedDict[int, ChatRing]" = OrderedDict()
+        self._bytes = 0
+        # Fills in flight: chat_id -> [fills, write generation]
+        self._fills: Dict[int, List[int]] = {}
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def contains(self, chat_id: int) -> bool:
+        return chat_id in self._rings
+
+    def get_page(self, chat_id: int, limit: int) -> Optional[Tuple[List[dict], bool]]:
+        """Newest `limit` messages and whether older ones exist, or None on a miss."""
+        ring = self._rings.get(chat_id)
+        if ring is not None and (limit <= len(ring.messages) or not ring.has_older):
+            self._rings.move_to_end(chat_id)
+            self.hits += 1
+            page = ring.messages[-limit:]
+            return page, len(ring.messages) > limit or ring.has_older
+        self.misses += 1
+        return None
+
+    def begin_fill(self, chat_id: int) -> int:
+        """Call before reading the page that will fill a ring; returns a token."""
+        fill = self._fills.setdefault(chat_id, [0, 0])
+        fill[0] += 1
+        return fill[1]
+
+    def abort_fill(self, chat_id: int):
+        """The read started with begin_fill failed."""
+        fill = self._fills[chat_id]
+        fill[0] -= 1
+        if not fill[0]:
+            del self._fills[chat_id]
+
+    def fill(self, chat_id: int, token: int, messages: List[dict], has_older: bool):
+        """Cache a chat's newest messages (oldest first) read since begin_fill."""
+        generation = self._fills[chat_id][1]
+        self.abort_fill(chat_id)
+        if generation != token:
+            return  # the chat was written to meanwhile, the page may be stale
+
+        if len(messages) > self.per_chat:
+            messages = messages[-self.per_chat:]
+            has_older = True
+        self._drop(chat_id)
+        ring = ChatRing(list(messages), has_older)
+        self._rings[chat_id] = ring
+        self._bytes += ring.size
+        self._evict()
+
+    def _written(self, chat_id: int):
+        fill = self._fills.get(chat_id)
+        if fill is not None:
+            fill[1] += 1
+
+    def _changed(self, **data):
+        """Tell the other workers about a write (see _on_message_cache_changed)."""
+        event_bus.publish("message_cache_changed", {"worker_id": event_bus.worker_id, **data})
+
+    def invalidate(self, chat_id: int):
+        """Forget a chat written to on another worker."""
+        self._written(chat_id)
+        self._drop(chat_id)
+
+    def append(self, chat_id: int, entry: Optional[dict]):
+        """A message was committed; entry is its dict if the chat was cached."""
+        self._written(chat_id)
+        self._changed(chat_id=chat_id)
+        ring = self._rings.get(chat_id)
+        if ring is None:
+            return
+        if entry is None:
+            # Cached after the message was built, possibly from a page read
+            # before the commit: let the next read refill it
+            self._drop(chat_id)
+            return
+        position = bisect.bisect_left(ring.ids, entry["id"])
+        if position < len(ring.ids) and ring.ids[position] == entry["id"]:
+            return
+        ring.ids.insert(position, entry["id"])
+        ring.messages.insert(position, entry)
+        ring.size += _size(entry)
+        self._bytes += _size(entry)
+        while len(ring.messages) > self.per_chat:
+            ring.ids.pop(0)
+            dropped = ring.messages.pop(0)
+            ring.size -= _size(dropped)
+            self._bytes -= _size(dropped)
+            ring.has_older = True
+        self._evict()
+
+    def _replace_where(self, ring: ChatRing, predicate, **changes):
+        for i, message in enumerate(ring.messages):
+            if predicate(message):
+                # Replace rather than mutate: pages already handed out stay intact
+                updated = {**message, **changes}
+                delta = _size(updated) - _size(message)
+                ring.messages[i] = updated
+                ring.size += delta
+                self._bytes += delta
+
+    def edit(self, chat_id: int, message_id: int, content: str):
+        """A message's content was changed and committed."""
+        self._written(chat_id)
+        self._changed(chat_id=chat_id)
+        ring = self._rings.get(chat_id)
+        if ring is None:
+            return
+        self._replace_where(ring, lambda m: m["id"] == message_id, content=content, is_edited=True)
+        self._replace_where(ring, lambda m: m["reply_to_id"] == message_id,
+                            reply_to_content=reply_preview(content))
+
+    def delete(self, chat_id: int, message_id: int):
+        """A message was deleted and the delete committed."""
+        self._written(chat_id)
+        self._changed(chat_id=chat_id)
+        ring = self._rings.get(chat_id)
+        if ring is None:
+            return
+        position = bisect.bisect_left(ring.ids, message_id)
+        if position < len(ring.ids) and ring.ids[position] == message_id:
+            ring.ids.pop(position)
+            dropped = ring.messages.pop(position)
+            ring.size -= _size(dropped)
+            self._bytes -= _size(dropped)
+        self._replace_where(ring, lambda m: m["reply_to_id"] == message_id, reply_to_content=None)
+
+    def set_status(self, message_ids: List[int], status: str):
+        """Delivery status of messages was changed and committed."""
+        self._set_status(message_ids, status)
+        self._changed(message_ids=list(message_ids), status=status)
+
+    def _set_status(self, message_ids: List[int], status: str):
+        ids = set(message_ids)
+        for ring in self._rings.values():
+            if not ids.isdisjoint(ring.ids):
+                self._replace_where(ring, lambda m: m["id"] in ids, status=status)
+
+    def rename_sender(self, user_id: int, display_name: str):
+        """A user's display name changed."""
+        self._rename_sender(user_id, display_name)
+        self._changed(user_id=user_id, display_name=display_name)
+
+    def _rename_sender(self, user_id: int, display_name: str):
+        for ring in self._rings.values():
+            self._replace_where(ring, lambda m: m["sender_id"] == user_id, sender_name=display_name)
+
+    def _drop(self, chat_id: int):
+        ring = self._rings.pop(chat_id, None)
+        if ring is not None:
+            self._bytes -= ring.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._rings:
+            _, ring = self._rings.popitem(last=False)
+            self._bytes -= ring.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "chats": len(self._rings),
+            "messages": sum(len(r.messages) for r in self._rings.values()),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+message_cache = MessageCache(Config.MESSAGE_CACHE_PER_CHAT, Config.MESSAGE_CACHE_MAX_BYTES)
+
+
+def _on_message_cache_changed(data: dict):
+    if data["worker_id"] == event_bus.worker_id:
+        return  # already applied by the writer
+    if "chat_id" in data:
+        message_cache.invalidate(data["chat_id"])
+    elif "status" in data:
+        message_cache._set_status(data["message_ids"], data["status"])
+    else:
+        message_cache._rename_sender(data["user_id"], data["display_name"])
+
+
+event_bus.on("message_cache_changed", _on_message_cache_changed)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Full-text message search.
+
+Messages are indexed in ``messages_fts``, an SQLite FTS5 table with the
+messages table as external content: the index holds only tokens and reads
+the text back from ``messages`` by rowid (the message id). Triggers keep it
+in sync with every insert, edit and delete, whichever code path does them.
+
+Results are ranked by BM25 and paged with a keyset cursor over
+``(score, id)``. Only the newest ``Config.SEARCH_MAX_MATCHES`` matches of a
+query in the caller's chats (or in the chat searched) are ranked, so a very
+common word costs about as much to rank as a rare one: it finds recent
+messages, and adding words reaches older ones. Finding those matches walks
+the query's matches newest first, in every chat, so a common word takes
+longer for a user whose chats hold few of its matches. Ranks depend on
+index-wide statistics, so a page boundary may shift slightly if many
+messages are indexed between two pages.
+
+The index is created, and existing messages indexed, by the migrations on
+first start. To rebuild it or merge its segments by hand:
+
+    python message_search.py rebuild
+    python message_search.py optimize
+"""
+import argparse
+import base64
+import binascii
+import re
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from settings import Config
+
+TABLE = "messages_fts"
+
+# Highlight markers around matched terms in snippets; content is not escaped
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+SNIPPET_TOKENS = 12
+
+# Terms beyond this are ignored
+MAX_TERMS = 16
+
+_DDL = (
+    f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+    "content, content='messages', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')"
+)
+# Dropped along with the messages table when the migrations rebuild it
+_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_ai AFTER INSERT ON messages BEGIN "
+    f"INSERT INTO {TABLE}(rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_ad AFTER DELETE ON messages BEGIN "
+    f"INSERT INTO {TABLE}({TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {TABLE}_au AFTER UPDATE OF content ON messages BEGIN "
+    f"INSERT INTO {TABLE}({TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+    f"INSERT INTO {TABLE}(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def ensure_index(conn) -> bool:
+    """Create the index and its triggers if missing; True if the index was created."""
+    created = TABLE not in inspect(conn).get_table_names()
+    if created:
+        conn.execute(text(_DDL))
+    for ddl in _TRIGGERS:
+        conn.execute(text(ddl))
+    return created
+
+
+def rebuild(conn):
+    """Re-index every message from the messages table."""
+    conn.execute(text(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')"))
+
+
+def optimize(conn):
+    """Merge the index into a single b-tree.
+
+    Worth doing after a rebuild or a large import, otherwise the next
+    writes pay for merging the segments those left behind.
+    """
+    conn.execute(text(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')"))
+
+
+def match_expression(query: str) -> Optional[str]:
+    """FTS5 query matching every word of a user's query.
+
+    User input is never passed to FTS5 as query syntax: words are quoted,
+    so operators and punctuation are treated as text. Words match whole
+    tokens only; prefix queries would merge the doclists of every matching
+    term on each search.
+    """
+    terms = re.findall(r"\w+", query)[:MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def encode_cursor(score: float, message_id: int) -> str:
+    """Opaque cursor after a search result."""
+    raw = f"{score!r}:{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Parse a cursor produced by encode_cursor; raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, message_id = base64.urlsafe_b64decode(padded).decode().split(":")
+        return float(score), int(message_id)
+    except (UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(cursor) from e
+
+
+def search_statement(user_id: int, match: str, chat_id: Optional[int], limit: int,
+                     after: Optional[Tuple[float, int]] = None):
+    """Statement and parameters for one page of results (best first).
+
+    Ranks the newest ``Config.SEARCH_MAX_MATCHES`` matches in chats the user
+    is a member of (and in `chat_id` if given); only the page gets snippets.
+    """
+    params = {
+        "user_id": user_id,
+        "match": match,
+        "max_matches": Config.SEARCH_MAX_MATCHES,
+        "limit": limit,
+        "start": SNIPPET_START,
+        "end": SNIPPET_END,
+        "tokens": SNIPPET_TOKENS
+    }
+    # The user's chats are looked up once, rather than a membership per match
+    filters = " AND m.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = :user_id)"
+    if chat_id is not None:
+        filters += " AND m.chat_id = :chat_id"
+        params["chat_id"] = chat_id
+    page = ""
+    if after is not None:
+        page = " WHERE r.score > :after_score OR (r.score = :after_score AND r.id < :after_id)"
+        params["after_score"], params["after_id"] = after
+    statement = text(
+        "SELECT m.id, m.chat_id, m.sender_id, u.display_name AS sender_name, m.content, "
+        f"m.content_type, m.created_at, (SELECT snippet({TABLE}, 0, :start, :end, '…', :tokens) "
+        f"FROM {TABLE} WHERE {TABLE} MATCH :match AND {TABLE}.rowid = r.id) AS snippet, r.score "
+        # "score", not "rank": that is FTS5's own column, which would rank every match
+        f"FROM (SELECT {TABLE}.rowid AS id, bm25({TABLE}) AS score FROM {TABLE} "
+        f"JOIN messages m ON m.id = {TABLE}.rowid "
+        f"WHERE {TABLE} MATCH :match{filters} "
+        f"ORDER BY {TABLE}.rowid DESC LIMIT :max_matches) r "
+        "JOIN messages m ON m.id = r.id "
+        f"JOIN users u ON u.id = m.sender_id{page} "
+        "ORDER BY r.score, r.id DESC "
+        "LIMIT :limit"
+    )
+    return statement, params
+
+
+async def search(session: AsyncSession, user_id: int, query: str, chat_id: Optional[int],
+                 limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of search results and the cursor of the next page, if any."""
+    match = match_expression(query)
+    if match is None:
+        return [], None
+    after = decode_cursor(cursor) if cursor else None
+    statement, params = search_statement(user_id, match, chat_id, limit + 1, after)
+    rows = (await session.execute(statement, params)).mappings().all()
+
+    results = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(results[-1]["score"], results[-1]["id"])
+    for result in results:
+        del result["score"]
+    return results, next_cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the message search index.")
+    parser.add_argument("command", choices=["rebuild", "optimize"])
+    parser.add_argument("--database", default=str(Config.DATABASE_PATH))
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{args.database}")
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        created = ensure_index(conn)
+        if args.command == "rebuild" or created:
+            rebuild(conn)
+        optimize(conn)
+    print(f"{args.command} of {TABLE} done in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
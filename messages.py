@@ -1,133 +1,248 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, desc
 from sqlalchemy.orm import selectinload
-from typing import List
+from typing import List, Optional, Tuple
 from datetime import datetime
+import base64
+import binascii
 
 from main import async_session
 from models import User, Chat, Message, MessageStatus
-from schemas import MessageCreate, MessageResponse
-from dependencies import get_current_user, get_db
+import chat_summary
+import update_log
+import message_search
+from message_cache import message_cache, serialize, reply_preview
+from membership import is_member
+from write_pipeline import write_pipeline
+from schemas import MessageCreate, MessageResponse, MessageSearchResult
+from dependencies import get_current_user, get_db, get_read_db
 
 router = APIRouter()
 
 
+async def _check_member(db: AsyncSession, chat_id: int, user_id: int):
+    """Raise 404/403 unless the user is a member of the chat.
+    
+    The chat row is only looked up to tell the two errors apart.
+    """
+    if await is_member(db, chat_id, user_id):
+        return
+    
+    chat_result = await db.execute(select(Chat.id).where(Chat.id == chat_id))
+    if chat_result.first() is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    raise HTTPException(status_code=403, detail="Not a member of this chat")
+
+
+def encode_cursor(direction: str, message_id: int) -> str:
+    """Build an opaque paging cursor ("before" or "after" a message)."""
+    raw = f"{direction}:{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Parse a cursor produced by encode_cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        direction, message_id = base64.urlsafe_b64decode(padded).decode().split(":")
+        if direction not in ("before", "after"):
+            raise ValueError(direction)
+        return direction, int(message_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def _fetch_before(db: AsyncSession, chat_id: int, before_id: Optional[int], limit: int):
+    """Newest `limit` messages older than before_id (oldest first) and a has-more flag."""
+    query = select(Message).where(Message.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    result = await db.execute(
+        query
+        .options(selectinload(Message.sender), selectinload(Message.reply_to))
+        .order_by(desc(Message.id))
+        .limit(limit + 1)
+    )
+    messages = result.scalars().all()
+    return list(reversed(messages[:limit])), len(messages) > limit
+
+
+async def _fetch_after(db: AsyncSession, chat_id: int, after_id: int, limit: int):
+    """Oldest `limit` messages newer than after_id and a has-more flag."""
+    result = await db.execute(
+        select(Message)
+        .options(selectinload(Message.sender), selectinload(Message.reply_to))
+        .where(Message.chat_id == chat_id)
+        .where(Message.id > after_id)
+        .order_by(Message.id)
+        .limit(limit + 1)
+    )
+    messages = result.scalars().all()
+    return list(messages[:limit]), len(messages) > limit
+
+
+def _serialize(message: Message) -> dict:
+    """Response dict of a message loaded with its sender and reply_to."""
+    reply_content = reply_preview(message.reply_to.content) if message.reply_to else None
+    return serialize(message, message.sender.display_name, reply_content)
+
+
+async def _fetch_newest(db: AsyncSession, chat_id: int, limit: int):
+    """Newest page as response dicts, from the hot-chat cache when possible."""
+    cached = message_cache.get_page(chat_id, limit)
+    if cached is not None:
+        return cached
+    
+    # Read a full ring's worth so the next first-page reads are hits
+    token = message_cache.begin_fill(chat_id)
+    try:
+        messages, has_more = await _fetch_before(db, chat_id, None, max(limit, message_cache.per_chat))
+    except BaseException:
+        message_cache.abort_fill(chat_id)
+        raise
+    entries = [_serialize(msg) for msg in messages]
+    message_cache.fill(chat_id, token, entries, has_more)
+    return entries[-limit:], has_more or len(entries) > limit
+
+
+@router.get("/search", response_model=List[MessageSearchResult])
+async def search_messages(
+    q: str,
+    response: Response,
+    chat_id: Optional[int] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Search messages in the current user's chats, best match first.
+    
+    Every word of `q` must match a whole word. `chat_id` restricts the
+    search to one chat. The next page is addressed by the
+    opaque cursor in the X-Next-Cursor response header.
+    """
+    user_id = current_user["user_id"]
+    limit = min(max(1, limit), 100)
+    
+    if chat_id is not None:
+        await _check_member(db, chat_id, user_id)
+    
+    try:
+        results, next_cursor = await message_search.search(db, user_id, q, chat_id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return results
+
+
 @router.get("/{chat_id}", response_model=List[MessageResponse])
 async def get_messages(
     chat_id: int,
+    response: Response,
     limit: int = 50,
     offset: int = 0,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    around_id: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Get messages for a chat."""
+    """Get messages for a chat, oldest first.
+    
+    Pages are addressed by message id (keyset pagination over the
+    ix_messages_chat_id_id index): `before_id`, `after_id`, `around_id`, or
+    an opaque `cursor` taken from the X-Older-Cursor / X-Newer-Cursor
+    response headers. Without any of them the newest page is returned,
+    served from the in-memory history of hot chats when possible.
+    `offset` still works but is deprecated, since it gets slower the
+    further back it goes.
+    """
     user_id = current_user["user_id"]
+    limit = max(1, limit)
     
-    # Verify chat exists and user is member
-    chat_result = await db.execute(
-        select(Chat).where(Chat.id == chat_id)
-    )
-    chat = chat_result.scalar_one_or_none()
+    await _check_member(db, chat_id, user_id)
     
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
+    if cursor is not None:
+        direction, cursor_id = decode_cursor(cursor)
+        if direction == "before":
+            before_id = cursor_id
+        else:
+            after_id = cursor_id
     
-    if user_id not in [m.id for m in chat.members]:
-        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    has_older = has_newer = False
+    if around_id is not None:
+        older, has_older = await _fetch_before(db, chat_id, around_id, limit // 2)
+        newer, has_newer = await _fetch_after(db, chat_id, around_id - 1, limit - len(older))
+        page = [_serialize(msg) for msg in older + newer]
+    elif after_id is not None:
+        messages, has_newer = await _fetch_after(db, chat_id, after_id, limit)
+        page = [_serialize(msg) for msg in messages]
+        has_older = bool(page)
+    elif before_id is not None:
+        messages, has_older = await _fetch_before(db, chat_id, before_id, limit)
+        page = [_serialize(msg) for msg in messages]
+        has_newer = bool(page)
+    elif not offset:
+        page, has_older = await _fetch_newest(db, chat_id, limit)
+    else:
+        # Deprecated offset paging
+        response.headers["Deprecation"] = "true"
+        result = await db.execute(
+            select(Message)
+            .options(selectinload(Message.sender), selectinload(Message.reply_to))
+            .where(Message.chat_id == chat_id)
+            .order_by(desc(Message.id))
+            .limit(limit)
+            .offset(offset)
+        )
+        page = [_serialize(msg) for msg in reversed(result.scalars().all())]
+        has_older = len(page) == limit
+        has_newer = bool(page)
     
-    # Get messages
-    result = await db.execute(
-        select(Message)
-        .options(selectinload(Message.sender), selectinload(Message.reply_to))
-        .where(Message.chat_id == chat_id)
-        .order_by(desc(Message.created_at))
-        .limit(limit)
-        .offset(offset)
-    )
-    messages = result.scalars().all()
+    if has_older and page:
+        response.headers["X-Older-Cursor"] = encode_cursor("before", page[0]["id"])
+    if has_newer and page:
+        response.headers["X-Newer-Cursor"] = encode_cursor("after", page[-1]["id"])
     
-    response = []
-    for msg in reversed(messages):  # Oldest first
-        reply_content = None
-        if msg.reply_to:
-            reply_content = msg.reply_to.content[:50] + "..." if len(msg.reply_to.content) > 50 else msg.reply_to.content
-        
-        response.append({
-            "id": msg.id,
-            "chat_id": msg.chat_id,
-            "sender_id": msg.sender_id,
-            "sender_name": msg.sender.display_name,
-            "content": msg.content,
-            "content_type": msg.content_type,
-            "status": msg.status.value if hasattr(msg.status, 'value') else str(msg.status),
-            "reply_to_id": msg.reply_to_id,
-            "reply_to_content": reply_content,
-            "created_at": msg.created_at,
-            "is_edited": msg.is_edited
-        })
-    
-    return response
+    return page
 
 
 @router.post("/", response_model=MessageResponse)
 async def send_message(
     message_data: MessageCreate,
     current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Send a new message."""
-    user_id = current_user["user_id"]
+    """Send a new message.
     
-    # Verify chat exists and user is member
-    chat_result = await db.execute(
-        select(Chat).where(Chat.id == message_data.chat_id)
-    )
-    chat = chat_result.scalar_one_or_none()
-    
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
+    The insert goes through the write pipeline; this session only reads, and
+    holds no connection while waiting for the batch.
+    """
+    user_id = current_user["user_id"]
     
-    if user_id not in [m.id for m in chat.members]:
-        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    await _check_member(db, message_data.chat_id, user_id)
+    # Give back the read connection (a membership cache miss took one)
+    await db.rollback()
     
-    # Create message
-    message = Message(
+    # Create message through the group-commit writer
+    message_id, _ = await write_pipeline.insert_message(
         chat_id=message_data.chat_id,
         sender_id=user_id,
         content=message_data.content,
         content_type=message_data.content_type,
-        status=MessageStatus.SENT,
         reply_to_id=message_data.reply_to_id
     )
     
-    db.add(message)
-    
-    # Update chat
-    chat.updated_at = datetime.utcnow()
-    
-    await db.commit()
-    await db.refresh(message)
-    await db.refresh(message.sender)
-    await db.refresh(message.reply_to)
-    
-    reply_content = None
-    if message.reply_to:
-        reply_content = message.reply_to.content[:50] + "..." if len(message.reply_to.content) > 50 else message.reply_to.content
-    
-    return {
-        "id": message.id,
-        "chat_id": message.chat_id,
-        "sender_id": message.sender_id,
-        "sender_name": message.sender.display_name,
-        "content": message.content,
-        "content_type": message.content_type,
-        "status": message.status.value if hasattr(message.status, 'value') else str(message.status),
-        "reply_to_id": message.reply_to_id,
-        "reply_to_content": reply_content,
-        "created_at": message.created_at,
-        "is_edited": message.is_edited
-    }
+    result = await db.execute(
+        select(Message)
+        .options(selectinload(Message.sender), selectinload(Message.reply_to))
+        .where(Message.id == message_id)
+    )
+    return _serialize(result.scalar_one())
 
 
 @router.delete("/{message_id}")
@@ -151,8 +266,18 @@ async def delete_message(
     if message.sender_id != user_id:
         raise HTTPException(status_code=403, detail="Can only delete your own messages")
     
+    chat_id = message.chat_id
     await db.delete(message)
+    await db.flush()
+    await chat_summary.record_delete(db, chat_id, message_id)
+    recorded = await update_log.record_chat_event(db, chat_id, {
+        "type": "message_deleted",
+        "id": message_id,
+        "chat_id": chat_id
+    })
     await db.commit()
+    message_cache.delete(chat_id, message_id)
+    update_log.push(recorded)
     
     return {"message": "Message deleted successfully"}
 
@@ -186,9 +311,19 @@ async def edit_message(
     message.is_edited = True
     message.edited_at = datetime.utcnow()
     
+    await db.flush()
+    await chat_summary.record_edit(db, message)
+    recorded = await update_log.record_chat_event(db, message.chat_id, {
+        "type": "message_edited",
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "content": message.content,
+        "edited_at": message.edited_at
+    })
     await db.commit()
-    await db.refresh(message)
-    await db.refresh(message.sender)
+    message_cache.edit(message.chat_id, message.id, message.content)
+    update_log.push(recorded)
+    await db.refresh(message, attribute_names=["sender"])
     
     return {
         "id": message.id,
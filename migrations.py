@@ -0,0 +1,182 @@
+"""Schema upgrades for existing Liime databases.
+
+``Base.metadata.create_all`` only creates missing tables, so columns and
+indexes added to tables that already exist are applied here.
+"""
+import fcntl
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
+
+from models import Base, Message, chat_members, search_key
+from chat_summary import PREVIEW_LENGTH
+import message_search
+import user_search
+
+logger = logging.getLogger(__name__)
+
+
+def _add_missing_columns(conn, table) -> list:
+    """Add model columns that are missing from the database table."""
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        col_type = column.type.compile(dialect=conn.dialect)
+        ddl = f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {col_type}'
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        conn.execute(text(ddl))
+        added.append(column.name)
+        logger.info(f"Added column {table.name}.{column.name}")
+    return added
+
+
+def _recreate_table(conn, table, insert="INSERT"):
+    """Replace a table by one created from its model, keeping the rows.
+
+    SQLite cannot change a primary key in place, so rows are copied into a
+    fresh table which then replaces the old one. Indexes and triggers go
+    with the old table; the rest of the migrations create them again.
+    """
+    metadata = MetaData()
+    # Referenced tables are needed to render the FOREIGN KEY clauses
+    for referenced in {fk.column.table for fk in table.foreign_keys}:
+        referenced.to_metadata(metadata)
+    new_table = table.to_metadata(metadata, name=f"{table.name}_new")
+    columns = ", ".join(f'"{c.name}"' for c in table.columns)
+    conn.execute(CreateTable(new_table))
+    conn.execute(text(
+        f"{insert} INTO {new_table.name} ({columns}) SELECT {columns} FROM {table.name}"
+    ))
+    conn.execute(text(f"DROP TABLE {table.name}"))
+    conn.execute(text(f"ALTER TABLE {new_table.name} RENAME TO {table.name}"))
+
+
+def _rebuild_with_primary_key(conn, table):
+    """Recreate a table whose primary key was added after it was created."""
+    if inspect(conn).get_pk_constraint(table.name)["constrained_columns"]:
+        return
+    # Rows that would duplicate a key are dropped
+    _recreate_table(conn, table, insert="INSERT OR IGNORE")
+    logger.info(f"Rebuilt {table.name} with primary key")
+
+
+def _rebuild_with_autoincrement(conn, table):
+    """Recreate a table created before its ids were made AUTOINCREMENT.
+
+    Without it SQLite gives the next row the id of a deleted newest row.
+    Rows keep their ids, so the message search index stays valid; the ids
+    of rows deleted before the rebuild can still be given out once.
+    """
+    sql = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": table.name}
+    ).scalar_one()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    _recreate_table(conn, table)
+    logger.info(f"Rebuilt {table.name} with AUTOINCREMENT")
+
+
+def _backfill_chat_summaries(conn):
+    """Populate the denormalized last-message columns on chats."""
+    conn.execute(text(
+        "UPDATE chats SET last_message_id = "
+        "(SELECT MAX(id) FROM messages WHERE messages.chat_id = chats.id)"
+    ))
+    conn.execute(text(
+        "UPDATE chats SET "
+        f"last_message_preview = (SELECT substr(content, 1, {PREVIEW_LENGTH}) FROM messages WHERE messages.id = chats.last_message_id), "
+        "last_message_at = (SELECT created_at FROM messages WHERE messages.id = chats.last_message_id), "
+        "last_message_sender_id = (SELECT sender_id FROM messages WHERE messages.id = chats.last_message_id) "
+        "WHERE last_message_id IS NOT NULL"
+    ))
+    logger.info("Backfilled chat summaries")
+
+
+def _backfill_read_state(conn):
+    """Number existing messages per chat and mark existing history as read."""
+    conn.execute(text(
+        "UPDATE messages SET seq = numbered.rn FROM ("
+        "SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS rn FROM messages"
+        ") AS numbered WHERE messages.id = numbered.id"
+    ))
+    conn.execute(text(
+        "UPDATE chats SET message_seq = "
+        "(SELECT COALESCE(MAX(seq), 0) FROM messages WHERE messages.chat_id = chats.id)"
+    ))
+    conn.execute(text(
+        "UPDATE chat_members SET "
+        "read_seq = (SELECT message_seq FROM chats WHERE chats.id = chat_members.chat_id), "
+        "last_read_message_id = (SELECT last_message_id FROM chats WHERE chats.id = chat_members.chat_id)"
+    ))
+    logger.info("Backfilled message sequence numbers and read cursors")
+
+
+def _backfill_user_search_keys(conn):
+    """Compute the normalized username and display name of existing users."""
+    rows = conn.execute(text("SELECT id, username, display_name FROM users")).all()
+    if rows:
+        conn.execute(
+            text("UPDATE users SET username_key = :username_key, display_name_key = :display_name_key WHERE id = :id"),
+            [
+                {"id": id, "username_key": search_key(username), "display_name_key": search_key(display_name)}
+                for id, username, display_name in rows
+            ]
+        )
+    logger.info("Backfilled user search keys")
+
+
+@contextmanager
+def schema_lock(database_path: Path):
+    """Hold an exclusive lock on the schema of a database.
+
+    Every worker sets up the schema when it starts, and ``uvicorn --workers``
+    starts them together. The checks in ``create_all`` and here (is the
+    table there, the column, the index) followed by the DDL are only safe
+    one worker at a time, so they run under this lock: the next worker
+    finds the schema complete and changes nothing.
+    """
+    with open(f"{database_path}.schema-lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_migrations(conn):
+    """Bring an existing database up to the current models.
+
+    Meant to be called through ``AsyncConnection.run_sync`` right after
+    ``create_all``, in the same transaction and under ``schema_lock``.
+    """
+    added = {}
+    for table in Base.metadata.sorted_tables:
+        added[table.name] = _add_missing_columns(conn, table)
+
+    _rebuild_with_primary_key(conn, chat_members)
+    _rebuild_with_autoincrement(conn, Message.__table__)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+    if "last_message_id" in added.get("chats", []):
+        _backfill_chat_summaries(conn)
+    if "seq" in added.get("messages", []):
+        _backfill_read_state(conn)
+    if "username_key" in added.get("users", []):
+        _backfill_user_search_keys(conn)
+    if user_search.ensure_index(conn):
+        user_search.rebuild(conn)
+        logger.info("Built the user search index")
+    if message_search.ensure_index(conn):
+        message_search.rebuild(conn)
+        message_search.optimize(conn)
+        logger.info("Built the message search index")
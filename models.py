@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Enum, Table
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Enum, Table, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from datetime import datetime
+from typing import Optional
 import enum
+import unicodedata
 
 Base = declarative_base()
 
@@ -10,8 +12,13 @@ Base = declarative_base()
 chat_members = Table(
     'chat_members',
     Base.metadata,
-    Column('chat_id', Integer, ForeignKey('chats.id')),
-    Column('user_id', Integer, ForeignKey('users.id'))
+    Column('chat_id', Integer, ForeignKey('chats.id'), primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    # Read cursor: newest message read and its per-chat sequence number
+    Column('last_read_message_id', Integer, nullable=True),
+    Column('read_seq', Integer, default=0, server_default="0"),
+    # Drives the chat list lookup (all chats of one user)
+    Index('ix_chat_members_user_id', 'user_id', 'chat_id')
 )
 
 
@@ -29,6 +36,14 @@ class MessageStatus(str, enum.Enum):
     FAILED = "failed"
 
 
+def search_key(value: Optional[str]) -> str:
+    """Casefolded text without accents, as compared by user search."""
+    if not value:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", value.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
 class User(Base):
     __tablename__ = "users"
     
@@ -44,10 +59,20 @@ class User(Base):
     last_seen = Column(DateTime, default=datetime.utcnow)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Sequence number of the user's newest update (see update_log.py)
+    update_seq = Column(Integer, default=0, server_default="0")
+    # search_key() of username and display_name, kept in sync below (see user_search.py)
+    username_key = Column(String, index=True)
+    display_name_key = Column(String, index=True)
     
     # Relationships
     sent_messages = relationship("Message", foreign_keys="Message.sender_id", back_populates="sender")
     owned_chats = relationship("Chat", back_populates="owner")
+    
+    @validates("username", "display_name")
+    def _update_search_key(self, name, value):
+        setattr(self, f"{name}_key", search_key(value))
+        return value
 
 
 class Chat(Base):
@@ -61,6 +86,14 @@ class Chat(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Denormalized summary of the newest message, maintained by chat_summary
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    last_message_sender_id = Column(Integer, nullable=True)
+    # Number of messages ever sent to the chat, used for unread counters
+    message_seq = Column(Integer, default=0, server_default="0")
+    
     # Relationships
     owner = relationship("User", back_populates="owned_chats")
     members = relationship("User", secondary=chat_members, backref="chats")
@@ -69,6 +102,13 @@ class Chat(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination of chat history and newest-message lookups
+        Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+        # Never hand out the id of a deleted message again: ids are used as
+        # cursors (history pages, read cursors) and as search index rowids
+        {'sqlite_autoincrement': True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey('chats.id'))
@@ -81,6 +121,8 @@ class Message(Base):
     is_edited = Column(Boolean, default=False)
     edited_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Position in the chat (Chat.message_seq at the time of sending)
+    seq = Column(Integer, nullable=True)
     
     # Relationships
     chat = relationship("Chat", back_populates="messages")
@@ -103,3 +145,22 @@ class Attachment(Base):
     
     # Relationships
     message = relationship("Message", back_populates="attachments")
+
+
+class UserUpdate(Base):
+    """An event in a user's update stream, kept so clients can catch up."""
+    __tablename__ = "user_updates"
+    
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=True)
+    payload = Column(Text)  # JSON of the event as pushed over the WebSocket
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class RevokedToken(Base):
+    """A logged-out access token, kept until it would have expired."""
+    __tablename__ = "revoked_tokens"
+    
+    digest = Column(String, primary_key=True)  # hex SHA-256 of the token
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,152 @@
+"""Password hashing off the event loop.
+
+Passwords are hashed with scrypt (``hashlib.scrypt``), a deliberately slow
+KDF: tens of milliseconds of CPU per hash at the default cost. Running that
+inline would stall every request and WebSocket of the worker during a login
+storm, so ``password_hasher`` runs it in a small thread pool (hashlib
+releases the GIL while hashing). At most ``Config.PASSWORD_HASH_WORKERS``
+hashes run at once and at most ``Config.PASSWORD_HASH_MAX_PENDING`` wait;
+beyond that callers get ``HasherBusy`` rather than an ever-growing queue.
+
+Stored hashes look like ``scrypt$<log2 n>$<r>$<p>$<salt>$<hash>`` (base64),
+so the cost can be raised later: ``verify`` reports hashes made with other
+parameters, and legacy ``salt:sha256`` hashes, as needing a rehash, which
+``auth.authenticate_user`` does on the next successful login.
+"""
+import asyncio
+import base64
+import hashlib
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from settings import Config
+
+SCHEME = "scrypt"
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+class HasherBusy(Exception):
+    """Too many hashes are queued; the caller should retry later."""
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def _scrypt(password: str, salt: bytes, log_n: int, r: int, p: int) -> bytes:
+    n = 1 << log_n
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=HASH_BYTES)
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured cost (blocking)."""
+    log_n, r, p = Config.PASSWORD_SCRYPT_LOG_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P
+    salt = secrets.token_bytes(SALT_BYTES)
+    return f"{SCHEME}${log_n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, log_n, r, p))}"
+
+
+def dummy_hash() -> str:
+    """A hash no password matches, at the configured cost.
+
+    Checking a password against it takes as long as against a real one, so
+    logins for unknown usernames can't be told apart by their timing.
+    """
+    log_n, r, p = Config.PASSWORD_SCRYPT_LOG_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P
+    return f"{SCHEME}${log_n}${r}${p}${_b64(bytes(SALT_BYTES))}${_b64(bytes(HASH_BYTES))}"
+
+
+def _verify_legacy(password: str, stored: str) -> bool:
+    salt, stored_hash = stored.split(":")
+    computed_hash = hashlib.sha256((salt + password).encode()).hexdigest()
+    return secrets.compare_digest(computed_hash, stored_hash)
+
+
+def verify_password(password: str, stored: str) -> Tuple[bool, bool]:
+    """Whether a password matches a stored hash, and whether to rehash it (blocking)."""
+    try:
+        if not stored.startswith(SCHEME + "$"):
+            return _verify_legacy(password, stored), True
+        _, log_n, r, p, salt, expected = stored.split("$")
+        log_n, r, p = int(log_n), int(r), int(p)
+        expected = _unb64(expected)
+        computed = _scrypt(password, _unb64(salt), log_n, r, p)
+    except (ValueError, AttributeError):
+        # binascii.Error (bad base64) is a ValueError
+        return False, False
+    current = (Config.PASSWORD_SCRYPT_LOG_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P)
+    return secrets.compare_digest(computed, expected), (log_n, r, p) != current
+
+
+class PasswordHasher:
+    """Bounded thread pool for hashing and verifying passwords."""
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        # Stats
+        self.hashes = 0
+        self.verifications = 0
+        self.rehashes = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_seconds = 0.0
+
+    async def _run(self, fn, *args):
+        if self.pending >= Config.PASSWORD_HASH_MAX_PENDING:
+            self.rejected += 1
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+            self._slots = asyncio.Semaphore(Config.PASSWORD_HASH_WORKERS)
+        self.pending += 1
+        try:
+            # Waiting here rather than in the executor's queue keeps
+            # cancelled requests from hashing anyway
+            async with self._slots:
+                started = time.perf_counter()
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+                self.total_seconds += time.perf_counter() - started
+                self.completed += 1
+                return result
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """Hash a new password; raises HasherBusy."""
+        self.hashes += 1
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, stored: str) -> Tuple[bool, bool]:
+        """(matches, needs rehash) for a stored hash; raises HasherBusy."""
+        self.verifications += 1
+        return await self._run(verify_password, password, stored)
+
+    def stop(self):
+        """Shut the pool down; it is created again on the next hash."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
+
+    def stats(self) -> dict:
+        return {
+            "hashes": self.hashes,
+            "verifications": self.verifications,
+            "rehashes": self.rehashes,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_seconds / self.completed * 1000, 2) if self.completed else 0.0
+        }
+
+
+password_hasher = PasswordHasher()
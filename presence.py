@@ -0,0 +1,178 @@
+"""Presence fan-out.
+
+Status changes are only sent to users who can see them: people who share a
+private chat or group with the subject (channels don't count) and users who
+subscribed to the subject's presence over the WebSocket.
+
+Changes are collected and flushed once per ``Config.PRESENCE_DEBOUNCE_SECONDS``
+by a single task. A connect/disconnect pair inside one window cancels out,
+and every recipient gets at most one frame per flush: ``status_change`` for
+a single change, ``status_changes`` with a list otherwise.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, Optional, Set
+
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, ChatType, chat_members
+from settings import Config
+from ws_hub import hub, OutboundEvent
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceNotifier:
+    """Debounces status changes and delivers them to interested users."""
+
+    def __init__(self):
+        self._pending: Dict[int, bool] = {}  # user_id -> latest status in this window
+        self._announced_online: Set[int] = set()
+        self._subscribers: Dict[int, Set[int]] = {}  # subject -> subscribers
+        self._subscriptions: Dict[int, Set[int]] = {}  # subscriber -> subjects
+        self._contacts: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (expires, contacts)
+        self._task: Optional[asyncio.Task] = None
+        # Stats
+        self.changes = 0
+        self.debounced = 0
+        self.frames = 0
+
+    def status_changed(self, user_id: int, is_online: bool):
+        """Record a status change; it is delivered with the next flush."""
+        self._pending[user_id] = is_online
+
+    def subscribe(self, subscriber_id: int, user_ids: Iterable[int]):
+        subjects = self._subscriptions.setdefault(subscriber_id, set())
+        for user_id in user_ids:
+            if len(subjects) >= Config.PRESENCE_MAX_SUBSCRIPTIONS:
+                break
+            subjects.add(user_id)
+            self._subscribers.setdefault(user_id, set()).add(subscriber_id)
+
+    def unsubscribe(self, subscriber_id: int, user_ids: Optional[Iterable[int]] = None):
+        """Drop some (or, without user_ids, all) subscriptions of a user."""
+        subjects = self._subscriptions.get(subscriber_id)
+        if not subjects:
+            return
+        for user_id in list(subjects if user_ids is None else user_ids):
+            subjects.discard(user_id)
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber_id)
+                if not subscribers:
+                    del self._subscribers[user_id]
+        if not subjects:
+            del self._subscriptions[subscriber_id]
+
+    def invalidate_contacts(self, user_ids: Iterable[int]):
+        """Forget cached contacts, e.g. after chat membership changed."""
+        for user_id in user_ids:
+            self._contacts.pop(user_id, None)
+
+    async def _load_contacts(self, session: AsyncSession, user_ids: Set[int]) -> Dict[int, FrozenSet[int]]:
+        """Contacts (members of shared non-channel chats) for several users."""
+        now = time.monotonic()
+        found = {}
+        missing = set()
+        for user_id in user_ids:
+            cached = self._contacts.get(user_id)
+            if cached is not None and cached[0] > now:
+                self._contacts.move_to_end(user_id)
+                found[user_id] = cached[1]
+            else:
+                missing.add(user_id)
+
+        if missing:
+            other = aliased(chat_members)
+            result = await session.execute(
+                select(chat_members.c.user_id, other.c.user_id)
+                .join(other, other.c.chat_id == chat_members.c.chat_id)
+                .join(Chat, Chat.id == chat_members.c.chat_id)
+                .where(chat_members.c.user_id.in_(missing))
+                .where(Chat.type != ChatType.CHANNEL)
+                .where(other.c.user_id != chat_members.c.user_id)
+            )
+            loaded = {user_id: set() for user_id in missing}
+            for user_id, contact_id in result:
+                loaded[user_id].add(contact_id)
+            expires = now + Config.PRESENCE_CONTACTS_TTL
+            for user_id, contacts in loaded.items():
+                found[user_id] = frozenset(contacts)
+                self._contacts[user_id] = (expires, found[user_id])
+            while len(self._contacts) > Config.PRESENCE_CONTACTS_CACHE_SIZE:
+                self._contacts.popitem(last=False)
+
+        return found
+
+    async def flush(self, session: AsyncSession):
+        """Deliver the status changes collected since the last flush."""
+        pending, self._pending = self._pending, {}
+        changes = []
+        for user_id, is_online in pending.items():
+            if is_online == (user_id in self._announced_online):
+                # Flapped back to the state everyone already knows
+                self.debounced += 1
+                continue
+            if is_online:
+                self._announced_online.add(user_id)
+            else:
+                self._announced_online.discard(user_id)
+            changes.append((user_id, is_online))
+        if not changes:
+            return
+
+        contacts = await self._load_contacts(session, {user_id for user_id, _ in changes})
+        per_recipient: Dict[int, list] = {}
+        for user_id, is_online in changes:
+            self.changes += 1
+            change = {"user_id": user_id, "is_online": is_online}
+            interested = contacts.get(user_id, frozenset()) | self._subscribers.get(user_id, set())
+            for recipient_id in interested:
+                if hub.is_online(recipient_id):
+                    per_recipient.setdefault(recipient_id, []).append(change)
+
+        for recipient_id, items in per_recipient.items():
+            if len(items) == 1:
+                payload = {"type": "status_change", **items[0]}
+            else:
+                payload = {"type": "status_changes", "changes": items}
+            hub.send_to_user(recipient_id, OutboundEvent(payload))
+            self.frames += 1
+
+    async def _run(self, session_factory):
+        while True:
+            await asyncio.sleep(Config.PRESENCE_DEBOUNCE_SECONDS)
+            if not self._pending:
+                continue
+            try:
+                async with session_factory() as session:
+                    await self.flush(session)
+            except Exception:
+                logger.exception("Failed to flush presence changes")
+
+    def start(self, session_factory):
+        """Start the flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(session_factory))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "changes": self.changes,
+            "debounced": self.debounced,
+            "frames": self.frames,
+            "subscriptions": sum(len(s) for s in self._subscriptions.values()),
+            "cached_contacts": len(self._contacts)
+        }
+
+
+presence_notifier = PresenceNotifier()
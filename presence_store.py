@@ -0,0 +1,183 @@
+"""Who is online, and when users were last seen.
+
+``presence_store`` is the one place presence is kept: ``/ws/online``, the
+event bus (which worker to deliver to) and the ``is_online`` and
+``last_seen`` of every ``UserResponse`` read it, not the users table.
+
+A user is online while they have a WebSocket on any worker (the event bus
+reports sockets opening and closing on every worker), or, without one,
+after declaring themselves online with ``POST /api/users/online``.
+``last_seen`` moves whenever their status is set or a socket of theirs
+opens or closes.
+
+The users table is only a copy for restarts and other readers: the worker
+that saw a change writes ``is_online`` and ``last_seen`` back, with one
+batched UPDATE per ``Config.PRESENCE_FLUSH_INTERVAL`` for all the users that
+changed in it, however often they did.
+"""
+import asyncio
+import dataclasses
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+_WRITE_BACK = text("UPDATE users SET is_online = :is_online, last_seen = :last_seen WHERE id = :user_id")
+
+
+class PresenceStore:
+    """In-memory presence of all users, written back in batches."""
+
+    def __init__(self):
+        self._workers: Dict[int, Set[str]] = {}  # user_id -> workers with a live socket
+        self._declared: Dict[int, bool] = {}  # status set over HTTP
+        self._last_seen: Dict[int, datetime] = {}
+        self._dirty: Set[int] = set()  # users to write back
+        self._task: Optional[asyncio.Task] = None
+        # Stats
+        self.changes = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._workers or self._declared.get(user_id, False)
+
+    def online_user_ids(self) -> List[int]:
+        online = set(self._workers)
+        online.update(user_id for user_id, is_online in self._declared.items() if is_online)
+        return list(online)
+
+    def workers(self, user_id: int) -> Iterable[str]:
+        """Workers where the user has a live socket."""
+        return self._workers.get(user_id, ())
+
+    def local_user_ids(self, worker_id: str) -> List[int]:
+        return [user_id for user_id, workers in self._workers.items() if worker_id in workers]
+
+    def declared_user_ids(self) -> List[int]:
+        """Users who declared themselves online over HTTP."""
+        return [user_id for user_id, is_online in self._declared.items() if is_online]
+
+    def last_seen(self, user_id: int) -> Optional[datetime]:
+        return self._last_seen.get(user_id)
+
+    def seen(self, user_id: int, write: bool = True):
+        """Record that a user was just active."""
+        self._last_seen[user_id] = datetime.utcnow()
+        self.changes += 1
+        if write:
+            self._dirty.add(user_id)
+
+    def set_socket_presence(self, worker_id: str, user_id: int, is_online: bool, write: bool) -> bool:
+        """Record a user's first socket opening / last closing on a worker.
+
+        `write` if this worker should write the change back. Returns whether
+        the user's status changed.
+        """
+        was_online = self.is_online(user_id)
+        workers = self._workers.get(user_id)
+        if is_online:
+            self._workers.setdefault(user_id, set()).add(worker_id)
+        elif workers is not None:
+            workers.discard(worker_id)
+            if not workers:
+                del self._workers[user_id]
+        self.seen(user_id, write)
+        return was_online != self.is_online(user_id)
+
+    def declare(self, user_id: int, is_online: bool, write: bool) -> bool:
+        """Record the status a user set; returns whether their status changed."""
+        was_online = self.is_online(user_id)
+        if is_online:
+            self._declared[user_id] = True
+        else:
+            self._declared.pop(user_id, None)
+        self.seen(user_id, write)
+        return was_online != self.is_online(user_id)
+
+    def current(self, user):
+        """Copy of a user snapshot with their current status and last_seen."""
+        return dataclasses.replace(
+            user,
+            is_online=self.is_online(user.id),
+            last_seen=self._last_seen.get(user.id, user.last_seen)
+        )
+
+    async def flush(self, session: AsyncSession) -> int:
+        """Write back the users that changed; the caller commits."""
+        dirty, self._dirty = self._dirty, set()
+        params = [
+            {"user_id": user_id, "is_online": self.is_online(user_id), "last_seen": self._last_seen[user_id]}
+            for user_id in dirty
+        ]
+        if params:
+            await session.execute(_WRITE_BACK, params)
+        return len(params)
+
+    def _forget_idle(self):
+        """Drop last_seen of users offline for long enough.
+
+        By then the row is written back and cached copies of it, which may
+        predate the write, have expired (Config.USER_CACHE_TTL).
+        """
+        horizon = datetime.utcnow() - timedelta(
+            seconds=Config.USER_CACHE_TTL + 2 * Config.PRESENCE_FLUSH_INTERVAL)
+        idle = [
+            user_id for user_id, last_seen in self._last_seen.items()
+            if last_seen < horizon and not self.is_online(user_id) and user_id not in self._dirty
+        ]
+        for user_id in idle:
+            del self._last_seen[user_id]
+
+    async def _run(self, session_factory):
+        while True:
+            await asyncio.sleep(Config.PRESENCE_FLUSH_INTERVAL)
+            dirty = self._dirty
+            try:
+                started = time.perf_counter()
+                async with session_factory() as session:
+                    written = await self.flush(session)
+                    await session.commit()
+                self.flushes += 1
+                self.rows_written += written
+                self.last_flush_ms = (time.perf_counter() - started) * 1000
+            except Exception:
+                self._dirty |= dirty
+                logger.exception("Failed to write back presence")
+            self._forget_idle()
+
+    def start(self, session_factory):
+        """Start the periodic write-back task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(session_factory))
+
+    async def stop(self, session_factory):
+        """Stop the write-back task and write whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        async with session_factory() as session:
+            await self.flush(session)
+            await session.commit()
+
+    def stats(self) -> dict:
+        return {
+            "online_users": len(self.online_user_ids()),
+            "tracked_users": len(self._last_seen),
+            "pending_writes": len(self._dirty),
+            "changes": self.changes,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "last_flush_ms": round(self.last_flush_ms, 2)
+        }
+
+
+presence_store = PresenceStore()
@@ -0,0 +1,149 @@
+"""Per-member read cursors and unread counters.
+
+Every message gets a per-chat sequence number (``Message.seq``) taken from
+``Chat.message_seq``. A member's read cursor stores the newest message they
+have read together with its sequence number (``chat_members.read_seq``), so
+the unread count of a chat is ``Chat.message_seq - read_seq``: O(1) to read
+and no per-member writes when a message is sent. Deleting a message does
+not renumber the chat, so it keeps counting as unread for members whose
+cursor has not passed it yet; a cursor moved to the chat's newest message
+takes ``Chat.message_seq``, so deleting the newest messages leaves nothing
+unread once the chat is read.
+
+Cursor advances coming from clients are buffered in ``read_cursors`` and
+written in one batch per flush interval, so a fast-scrolling client does
+not cause a write per message.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from sqlalchemy import update, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, chat_members
+from settings import Config
+
+logger = logging.getLogger(__name__)
+
+
+def unread_count(message_seq: Optional[int], read_seq: Optional[int]) -> int:
+    """Unread messages for a member given the chat and cursor sequences."""
+    return max(0, (message_seq or 0) - (read_seq or 0))
+
+
+async def next_message_seq(session: AsyncSession, chat_id: int) -> int:
+    """Allocate the sequence number for a new message in a chat."""
+    result = await session.execute(
+        update(Chat)
+        .where(Chat.id == chat_id)
+        .values(message_seq=Chat.message_seq + 1, updated_at=Chat.updated_at)
+        .returning(Chat.message_seq)
+    )
+    return result.scalar_one()
+
+
+async def mark_read(session: AsyncSession, chat_id: int, user_id: int, message_id: int, seq: int):
+    """Move a member's cursor right away (used when they send a message)."""
+    await session.execute(
+        update(chat_members)
+        .where(chat_members.c.chat_id == chat_id)
+        .where(chat_members.c.user_id == user_id)
+        .values(last_read_message_id=message_id, read_seq=seq)
+    )
+
+
+# Only moves cursors forward (by seq: the id of a deleted message may be
+# handed out again) and ignores messages from other chats. Reading up to the
+# chat's newest message reads the whole chat, including newer messages that
+# were deleted since.
+_ADVANCE_CURSOR = text(
+    "UPDATE chat_members SET last_read_message_id = :message_id, read_seq = target.seq "
+    "FROM (SELECT CASE WHEN c.last_message_id = m.id THEN c.message_seq ELSE m.seq END AS seq "
+    "FROM messages m JOIN chats c ON c.id = m.chat_id "
+    "WHERE m.id = :message_id AND m.chat_id = :chat_id) AS target "
+    "WHERE chat_members.chat_id = :chat_id AND chat_members.user_id = :user_id "
+    "AND COALESCE(chat_members.read_seq, 0) < target.seq"
+)
+
+
+class ReadCursorBuffer:
+    """Collects read cursor advances and writes them in batches."""
+
+    def __init__(self):
+        # user_id -> {chat_id: newest message_id read}
+        self._pending: Dict[int, Dict[int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def advance(self, chat_id: int, user_id: int, message_id: int):
+        """Record that a user has read a chat up to message_id."""
+        chats = self._pending.setdefault(user_id, {})
+        if message_id > chats.get(chat_id, 0):
+            chats[chat_id] = message_id
+
+    def pending_count(self) -> int:
+        return sum(len(chats) for chats in self._pending.values())
+
+    def take(self, user_id: Optional[int] = None) -> Dict[int, Dict[int, int]]:
+        """Remove pending cursors (all, or one user's) to write them.
+
+        Give them back with restore() if the write fails.
+        """
+        if user_id is None:
+            pending, self._pending = self._pending, {}
+            return pending
+        chats = self._pending.pop(user_id, None)
+        return {user_id: chats} if chats else {}
+
+    def restore(self, pending: Dict[int, Dict[int, int]]):
+        """Put back cursors whose write failed, keeping newer advances."""
+        for user_id, chats in pending.items():
+            for chat_id, message_id in chats.items():
+                self.advance(chat_id, user_id, message_id)
+
+    async def write(self, session: AsyncSession, pending: Dict[int, Dict[int, int]]) -> int:
+        """Write cursors obtained from take() using the given session.
+
+        The caller is responsible for committing.
+        """
+        params = [
+            {"chat_id": chat_id, "user_id": uid, "message_id": message_id}
+            for uid, chats in pending.items()
+            for chat_id, message_id in chats.items()
+        ]
+        if params:
+            await session.execute(_ADVANCE_CURSOR, params)
+        return len(params)
+
+    async def _flush(self, session_factory):
+        pending = self.take()
+        try:
+            async with session_factory() as session:
+                await self.write(session, pending)
+                await session.commit()
+        except Exception:
+            self.restore(pending)
+            raise
+
+    async def _run(self, session_factory):
+        while True:
+            await asyncio.sleep(Config.READ_CURSOR_FLUSH_INTERVAL)
+            try:
+                await self._flush(session_factory)
+            except Exception:
+                logger.exception("Failed to flush read cursors")
+
+    def start(self, session_factory):
+        """Start the periodic flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(session_factory))
+
+    async def stop(self, session_factory):
+        """Stop the flush task and write whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._flush(session_factory)
+
+
+read_cursors = ReadCursorBuffer()
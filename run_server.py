@@ -9,5 +9,6 @@ if __name__ == "__main__":
         host=Config.HOST,
         port=Config.PORT,
         reload=Config.DEBUG,
-        log_level="info"
+        log_level="info",
+        ws_per_message_deflate=Config.WS_PER_MESSAGE_DEFLATE
     )
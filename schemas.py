@@ -27,6 +27,10 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class UserBatchRequest(BaseModel):
+    ids: List[int]
+    format: Optional[str] = None  # "compact" for rows of values
+
 # Chat schemas
 class ChatType(str, Enum):
     PRIVATE = "private"
@@ -47,6 +51,9 @@ class ChatResponse(BaseModel):
     created_at: datetime
     last_message: Optional[str] = None
     last_message_time: Optional[datetime] = None
+    last_message_id: Optional[int] = None
+    last_message_sender_id: Optional[int] = None
+    last_read_message_id: Optional[int] = None
     unread_count: int = 0
     
     class Config:
@@ -82,6 +89,16 @@ class MessageResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class MessageSearchResult(BaseModel):
+    id: int
+    chat_id: int
+    sender_id: int
+    sender_name: str
+    content: str
+    content_type: str
+    snippet: str  # matched terms wrapped in <mark></mark>
+    created_at: datetime
+
 # Auth schemas
 class Token(BaseModel):
     access_token: str
@@ -90,3 +107,4 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    user_id: Optional[int] = None
@@ -1,5 +1,6 @@
 """Configuration for Liime Server"""
 import os
+import tempfile
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Optional
@@ -16,19 +17,85 @@ class Config:
     # Database configuration
     BASE_DIR: Path = Path(__file__).resolve().parent
     DATABASE_PATH: Path = BASE_DIR / "liime.db"
+    DATABASE_PROFILE: str = "default"  # "default" or "production" (see db_profile.py)
+    DATABASE_READ_POOL_SIZE: int = 4  # read connections in the production profile
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024  # 256 MB
+    SQLITE_CACHE_SIZE_KB: int = 64 * 1024  # 64 MB per connection
     
     # JWT configuration
     SECRET_KEY: str = "your-secret-key-change-in-production"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 7  # 1 week
+    TOKEN_CACHE_SIZE: int = 100_000  # verified tokens kept (see token_auth.py)
+    TOKEN_CACHE_TTL: int = 300  # seconds before a cached token is verified again
+    
+    # Password hashing configuration (scrypt, see password_hashing.py)
+    PASSWORD_SCRYPT_LOG_N: int = 14  # cost: n = 2**14, 16 MB and ~50 ms per hash
+    PASSWORD_SCRYPT_R: int = 8
+    PASSWORD_SCRYPT_P: int = 1
+    PASSWORD_HASH_WORKERS: int = 2  # hashes running at once (threads)
+    PASSWORD_HASH_MAX_PENDING: int = 256  # logins waiting beyond this get a 503
     
     # File upload configuration
     MAX_FILE_SIZE: int = 50 * 1024 * 1024  # 50 MB
     UPLOAD_DIR: Path = BASE_DIR / "uploads"
     
     # WebSocket configuration
-    WS_HEARTBEAT_INTERVAL: int = 30
-    WS_PING_TIMEOUT: int = 60
+    WS_HEARTBEAT_INTERVAL: int = 30  # idle connections are pinged after this
+    WS_PING_TIMEOUT: int = 60  # and closed after this without any frame
+    WS_HEARTBEAT_TICK: float = 1.0  # resolution of the heartbeat timer wheel
+    WS_SEND_QUEUE_SIZE: int = 256  # outbound events buffered per connection
+    WS_SLOW_CONSUMER_POLICY: str = "coalesce"  # "drop_oldest", "coalesce" or "disconnect"
+    WS_BATCH_WINDOW_MS: float = 5.0  # events batched per frame (compact formats)
+    WS_PER_MESSAGE_DEFLATE: bool = True  # compression state costs ~90 KB per socket
+    
+    # Presence configuration
+    PRESENCE_DEBOUNCE_SECONDS: float = 1.0  # status changes are batched per window
+    PRESENCE_CONTACTS_TTL: int = 60  # seconds a user's contact list is cached
+    PRESENCE_CONTACTS_CACHE_SIZE: int = 50_000
+    PRESENCE_MAX_SUBSCRIPTIONS: int = 500  # explicit presence subscriptions per user
+    PRESENCE_FLUSH_INTERVAL: float = 5.0  # seconds between is_online/last_seen write-backs
+    
+    # Typing indicator configuration
+    TYPING_INTERVAL: float = 1.0  # typing changes are delivered once per interval
+    TYPING_TIMEOUT: float = 6.0  # a typing session ends without a refresh
+    
+    # Channel configuration
+    CHANNEL_BROADCAST_BATCH: int = 1000  # subscribers handled between event loop yields
+    
+    # Event bus configuration (realtime events across workers)
+    EVENT_BUS_BACKEND: str = "inprocess"  # "inprocess" or "unix"
+    EVENT_BUS_DIR: Path = Path(tempfile.gettempdir()) / "liime-bus"
+    EVENT_BUS_HEARTBEAT_INTERVAL: float = 5.0
+    EVENT_BUS_MAX_DATAGRAM: int = 32 * 1024  # larger messages are sent in fragments
+    EVENT_BUS_BACKLOG: int = 10_000  # datagrams waiting per peer whose buffer is full
+    
+    # Update stream configuration (catch-up after reconnects)
+    UPDATES_LOG_SIZE: int = 1000  # updates kept per user
+    UPDATES_DIFFERENCE_LIMIT: int = 500  # larger gaps get a chat summary instead
+    UPDATES_FANOUT_MAX_MEMBERS: int = 200  # larger groups are caught up like channels
+    
+    # Read state configuration
+    READ_CURSOR_FLUSH_INTERVAL: float = 2.0  # seconds between batched cursor writes
+    MEMBERSHIP_CACHE_SIZE: int = 100_000  # cached (chat, user) membership answers
+    
+    # Message cache configuration (newest messages of hot chats)
+    MESSAGE_CACHE_PER_CHAT: int = 100  # messages kept per cached chat
+    MESSAGE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024  # 64 MB for all chats
+    
+    # User cache configuration (profiles, see user_cache.py)
+    USER_CACHE_SIZE: int = 100_000  # users kept
+    USER_CACHE_TTL: int = 300  # seconds before a cached user is read again
+    USER_CACHE_NEGATIVE_TTL: int = 30  # seconds a free username/email is remembered
+    USER_BATCH_MAX_IDS: int = 500  # users resolved per /api/users/batch request
+    
+    # Search configuration
+    SEARCH_MAX_MATCHES: int = 10_000  # newest matches of a query that get ranked
+    
+    # Write pipeline configuration
+    WRITE_BATCH_WINDOW_MS: float = 2.0  # how long the writer waits to fill a batch
+    WRITE_BATCH_MAX_SIZE: int = 128  # operations committed per transaction at most
     
     def __post_init__(self):
         """Create upload directory after initialization"""
@@ -41,9 +108,12 @@ class Config:
             HOST=os.getenv("LIIME_HOST", cls.HOST),
             PORT=int(os.getenv("LIIME_PORT", str(cls.PORT))),
             DEBUG=os.getenv("LIIME_DEBUG", "false").lower() == "true",
+            DATABASE_PROFILE=os.getenv("LIIME_DB_PROFILE", cls.DATABASE_PROFILE),
+            EVENT_BUS_BACKEND=os.getenv("LIIME_EVENT_BUS", cls.EVENT_BUS_BACKEND),
+            EVENT_BUS_DIR=Path(os.getenv("LIIME_EVENT_BUS_DIR", str(cls.EVENT_BUS_DIR))),
             SECRET_KEY=os.getenv("LIIME_SECRET_KEY", cls.SECRET_KEY)
         )
 
 
-# Module-level config instance
-Config = Config()
+# Module-level config instance, with the LIIME_* environment overrides
+Config = Config.from_env()
@@ -0,0 +1,78 @@
+"""Unread counts after reading a chat whose newest messages were deleted."""
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # Before main is imported, which opens the database
+    settings.Config.DATABASE_PATH = tmp_path_factory.mktemp("db") / "liime.db"
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+
+def register(client, username):
+    user = {"username": username, "email": f"{username}@example.com",
+            "password": "secret", "display_name": username}
+    assert client.post("/api/auth/register", json=user).status_code == 200
+    response = client.post("/api/auth/login", json={"username": username, "password": "secret"})
+    body = response.json()
+    return body["user"]["id"], {"Authorization": f"Bearer {body['access_token']}"}
+
+
+def send(client, headers, chat_id, content):
+    response = client.post("/api/messages/", json={"chat_id": chat_id, "content": content},
+                           headers=headers)
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def unread(client, headers, chat_id):
+    chats = client.get("/api/chats/", headers=headers).json()
+    return next(chat["unread_count"] for chat in chats if chat["id"] == chat_id)
+
+
+@pytest.fixture
+def chat(client, request):
+    name = request.node.name.replace("_", "")[-20:]
+    _, sender = register(client, f"s{name}")
+    reader_id, reader = register(client, f"r{name}")
+    response = client.post("/api/chats/", json={"title": name, "type": "group",
+                                                "member_ids": [reader_id]}, headers=sender)
+    return response.json()["id"], sender, reader
+
+
+def test_read_after_deleting_newest(client, chat):
+    chat_id, sender, reader = chat
+    for i in range(5):
+        newest = send(client, sender, chat_id, f"message {i}")
+    assert unread(client, reader, chat_id) == 5
+
+    client.delete(f"/api/messages/{newest}", headers=sender)
+    client.post(f"/api/chats/{chat_id}/read", headers=reader)
+    assert unread(client, reader, chat_id) == 0
+
+
+
+def test_read_after_newest_id_is_reused(client, chat):
+    chat_id, sender, reader = chat
+    for i in range(3):
+        newest = send(client, sender, chat_id, f"message {i}")
+    client.post(f"/api/chats/{chat_id}/read", params={"message_id": newest}, headers=reader)
+    assert unread(client, reader, chat_id) == 0
+
+    # A message sent after deleting the newest may get the same id
+    client.delete(f"/api/messages/{newest}", headers=sender)
+    newest = send(client, sender, chat_id, "message 3")
+    assert unread(client, reader, chat_id) == 1
+
+    client.post(f"/api/chats/{chat_id}/read", params={"message_id": newest}, headers=reader)
+    assert unread(client, reader, chat_id) == 0
@@ -0,0 +1,135 @@
+"""Verified access tokens.
+
+Verifying a JWT (HMAC and claim parsing in python-jose) is a measurable
+share of CPU on chatty endpoints, and clients send the same token with
+every request. ``TokenVerifier`` keeps the principal of verified tokens in
+an LRU keyed by the token's SHA-256 digest, so raw tokens are not kept in
+memory. An entry lives until the token expires or for
+``Config.TOKEN_CACHE_TTL`` seconds, whichever comes first, so a changed
+signing key is picked up.
+
+Logging out revokes a token: its digest is stored in ``revoked_tokens``
+until the token would have expired and announced on the event bus, so every
+worker rejects it at once. Revoked digests are loaded again on startup.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Tuple
+
+from jose import JWTError, jwt
+from pydantic import ValidationError
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import RevokedToken
+from schemas import TokenData
+from settings import Config
+from event_bus import event_bus
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidToken(Exception):
+    """The token is malformed, expired, badly signed or revoked."""
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenVerifier:
+    """Cache of verified tokens and the set of revoked ones."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: "OrderedDict[bytes, Tuple[dict, float, float]]" = OrderedDict()  # principal, exp, cached until
+        self._revoked: Dict[bytes, float] = {}  # digest -> exp
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def verify(self, token: str) -> dict:
+        """The principal ({"username", "user_id"}) of a valid token."""
+        digest = token_digest(token)
+        now = time.time()
+        entry = self._cache.get(digest)
+        if entry is not None:
+            principal, _, cached_until = entry
+            if now < cached_until:
+                self._cache.move_to_end(digest)
+                self.hits += 1
+                return dict(principal)
+            del self._cache[digest]
+
+        self.misses += 1
+        if digest in self._revoked:
+            self.rejected += 1
+            raise InvalidToken("Token revoked")
+        try:
+            payload = jwt.decode(token, Config.SECRET_KEY, algorithms=[Config.ALGORITHM])
+            token_data = TokenData(username=payload.get("sub"), user_id=payload.get("user_id"))
+        except (JWTError, ValidationError) as e:
+            self.rejected += 1
+            raise InvalidToken(str(e)) from e
+        if token_data.username is None or token_data.user_id is None:
+            self.rejected += 1
+            raise InvalidToken("Missing claims")
+
+        principal = {"username": token_data.username, "user_id": token_data.user_id}
+        exp = payload["exp"]
+        self._cache[digest] = (principal, exp, min(exp, now + self.ttl))
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+        return dict(principal)
+
+    def _revoke_local(self, digest: bytes, exp: float):
+        self._cache.pop(digest, None)
+        self._revoked[digest] = exp
+        # Logouts are rare: forget tokens that have expired anyway
+        now = time.time()
+        for expired in [d for d, e in self._revoked.items() if e <= now]:
+            del self._revoked[expired]
+
+    def _revoked_elsewhere(self, data: dict):
+        self._revoke_local(bytes.fromhex(data["digest"]), data["exp"])
+
+    async def revoke(self, session: AsyncSession, token: str):
+        """Reject a verified token from now on, on every worker (logout)."""
+        digest = token_digest(token)
+        exp = jwt.get_unverified_claims(token)["exp"]
+        await session.merge(RevokedToken(digest=digest.hex(), expires_at=datetime.utcfromtimestamp(exp)))
+        await session.commit()
+        event_bus.publish("token_revoked", {"digest": digest.hex(), "exp": exp})
+
+    async def start(self, session_factory):
+        """Load the revoked tokens that have not expired yet."""
+        async with session_factory() as session:
+            await session.execute(delete(RevokedToken).where(RevokedToken.expires_at <= datetime.utcnow()))
+            result = await session.execute(select(RevokedToken.digest, RevokedToken.expires_at))
+            for digest, expires_at in result.all():
+                self._revoked[bytes.fromhex(digest)] = (expires_at - datetime(1970, 1, 1)).total_seconds()
+            await session.commit()
+        logger.info(f"Loaded {len(self._revoked)} revoked tokens")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._cache),
+            "revoked": len(self._revoked),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "rejected": self.rejected,
+            "evictions": self.evictions
+        }
+
+
+token_verifier = TokenVerifier(Config.TOKEN_CACHE_SIZE, Config.TOKEN_CACHE_TTL)
+event_bus.on("token_revoked", token_verifier._revoked_elsewhere)
@@ -0,0 +1,131 @@
+"""Typing indicators.
+
+Clients send a ``typing`` frame per keystroke; this module turns them into
+typing sessions per (chat, user) that expire after
+``Config.TYPING_TIMEOUT`` seconds without a refresh. A single task wakes up
+every ``Config.TYPING_INTERVAL`` seconds, expires sessions and tells the
+other chat members about sessions that started or stopped since the last
+tick. Refreshing an active session sends nothing, and a start/stop pair
+within one interval cancels out, so members get at most one "started"
+and one "stopped" per session and interval.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Chat, ChatType, chat_members
+from settings import Config
+from event_bus import event_bus
+
+logger = logging.getLogger(__name__)
+
+TypingKey = Tuple[int, int]  # (chat_id, user_id)
+
+
+class TypingNotifier:
+    """Tracks typing sessions and fans out their changes once per tick."""
+
+    def __init__(self):
+        self._expires: Dict[TypingKey, float] = {}  # active sessions
+        self._announced: Set[TypingKey] = set()  # sessions members were told about
+        self._task: Optional[asyncio.Task] = None
+        # Stats
+        self.frames_received = 0
+        self.started = 0
+        self.stopped = 0
+
+    def typing(self, chat_id: int, user_id: int, is_typing: bool = True):
+        """Record a typing frame from a client."""
+        self.frames_received += 1
+        key = (chat_id, user_id)
+        if is_typing:
+            self._expires[key] = time.monotonic() + Config.TYPING_TIMEOUT
+        else:
+            self._expires.pop(key, None)
+
+    def clear_user(self, user_id: int, chat_id: Optional[int] = None):
+        """Stop a user's sessions (in one chat, or all of them)."""
+        for key in [k for k in self._expires if k[1] == user_id and chat_id in (None, k[0])]:
+            del self._expires[key]
+
+    async def _members(self, session: AsyncSession, chat_ids: Set[int]) -> Dict[int, Set[int]]:
+        """Members of the given chats; channels have no typing indicators."""
+        result = await session.execute(
+            select(chat_members.c.chat_id, chat_members.c.user_id)
+            .join(Chat, Chat.id == chat_members.c.chat_id)
+            .where(chat_members.c.chat_id.in_(chat_ids))
+            .where(Chat.type != ChatType.CHANNEL)
+        )
+        members: Dict[int, Set[int]] = {}
+        for chat_id, user_id in result:
+            members.setdefault(chat_id, set()).add(user_id)
+        return members
+
+    async def tick(self, session: AsyncSession):
+        """Expire sessions and deliver what started or stopped since the last tick."""
+        now = time.monotonic()
+        for key in [k for k, expires in self._expires.items() if expires <= now]:
+            del self._expires[key]
+
+        active = set(self._expires)
+        started = active - self._announced
+        stopped = self._announced - active
+        if not started and not stopped:
+            return
+        self._announced = active
+
+        members = await self._members(session, {chat_id for chat_id, _ in started | stopped})
+        for changes, is_typing in ((started, True), (stopped, False)):
+            for chat_id, user_id in changes:
+                recipients = members.get(chat_id, set())
+                if user_id not in recipients:
+                    # Not a member (or a channel): nobody is told
+                    self._expires.pop((chat_id, user_id), None)
+                    self._announced.discard((chat_id, user_id))
+                    continue
+                event_bus.publish_to_users(recipients - {user_id}, {
+                    "type": "typing",
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "is_typing": is_typing
+                }, coalesce_key=("typing", chat_id, user_id))
+                if is_typing:
+                    self.started += 1
+                else:
+                    self.stopped += 1
+
+    async def _run(self, session_factory):
+        while True:
+            await asyncio.sleep(Config.TYPING_INTERVAL)
+            if not self._expires and not self._announced:
+                continue
+            try:
+                async with session_factory() as session:
+                    await self.tick(session)
+            except Exception:
+                logger.exception("Failed to deliver typing indicators")
+
+    def start(self, session_factory):
+        """Start the timer task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(session_factory))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._expires),
+            "frames_received": self.frames_received,
+            "started": self.started,
+            "stopped": self.stopped
+        }
+
+
+typing_notifier = TypingNotifier()
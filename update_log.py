@@ -0,0 +1,228 @@
+"""Per-user update stream.
+
+Durable events (new, edited and deleted messages, joining and leaving
+chats) get a per-user sequence number (``User.update_seq``) and are stored
+in ``user_updates`` in the same transaction as the change itself. After the
+commit they are pushed over the WebSocket with their ``seq`` and ``date``,
+so a client that reconnects asks for the updates after the last ``seq`` it
+has seen instead of re-polling every chat.
+
+The log is bounded to about ``Config.UPDATES_LOG_SIZE`` updates per user.
+If a client is further behind than that (or than
+``Config.UPDATES_DIFFERENCE_LIMIT``), it gets a compact summary of the
+chats changed since its last ``date`` instead and reloads those.
+
+Events of channels and of groups larger than
+``Config.UPDATES_FANOUT_MAX_MEMBERS`` are not written to members' logs
+(the fan-out would be a row and a sequence bump per member, in the single
+writer): they are delivered live by channel_broadcast and caught up from
+the chat summary, positioned by the chat's own sequence
+(``Chat.message_seq``). ``get_difference`` lists those chats changed since
+the client's ``date`` even when its ``seq`` is current.
+Typing, presence and read receipts are not logged either.
+"""
+import json
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import select, update, insert, desc, text, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import User, Chat, ChatType, UserUpdate, chat_members
+from settings import Config
+from read_state import unread_count
+from event_bus import event_bus
+from channel_broadcast import channel_broadcaster
+
+# Old updates are pruned once every PRUNE_EVERY updates of a user
+PRUNE_EVERY = 100
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+_PRUNE = text(
+    "DELETE FROM user_updates WHERE user_id = :user_id AND seq <= :upto"
+)
+
+
+_members = chat_members.alias()
+
+
+def _unlogged():
+    """Condition on Chat: its events are broadcast rather than logged per member."""
+    member_count = (
+        select(func.count()).select_from(_members)
+        .where(_members.c.chat_id == Chat.id)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    return (Chat.type == ChatType.CHANNEL) | (member_count > Config.UPDATES_FANOUT_MAX_MEMBERS)
+
+
+async def record_chat_event(session: AsyncSession, chat_id: int, payload: dict) -> dict:
+    """Append a message event to the streams of a chat's members.
+
+    For channels and large groups nothing is stored; ``push`` broadcasts
+    the event instead.
+    """
+    result = await session.execute(select(Chat.type).where(Chat.id == chat_id))
+    member_ids = []
+    if result.scalar_one_or_none() != ChatType.CHANNEL:
+        result = await session.execute(
+            select(chat_members.c.user_id)
+            .where(chat_members.c.chat_id == chat_id)
+            .limit(Config.UPDATES_FANOUT_MAX_MEMBERS + 1)
+        )
+        member_ids = list(result.scalars())
+    if not member_ids or len(member_ids) > Config.UPDATES_FANOUT_MAX_MEMBERS:
+        recorded = await record(session, [], payload, chat_id=chat_id)
+        recorded["broadcast_chat_id"] = chat_id
+        return recorded
+
+    return await record(session, member_ids, payload, chat_id=chat_id)
+
+
+async def record(session: AsyncSession, user_ids: Iterable[int], payload: dict,
+                 chat_id: Optional[int] = None) -> dict:
+    """Append an event to the streams of several users.
+
+    Allocates every user's next sequence number with one UPDATE ... RETURNING
+    and stores the event; the caller commits and then calls ``push`` with the
+    returned value.
+    """
+    user_ids = list(user_ids)
+    now = datetime.utcnow()
+    # Stored and pushed in the same (JSON) form
+    data = json.dumps(payload, default=_json_default)
+    payload = json.loads(data)
+    if not user_ids:
+        return {"payload": payload, "date": now, "seqs": {}}
+
+    result = await session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(update_seq=User.update_seq + 1, updated_at=User.updated_at)
+        .returning(User.id, User.update_seq)
+    )
+    seqs = dict(result.all())
+
+    await session.execute(insert(UserUpdate), [
+        {"user_id": user_id, "seq": seq, "chat_id": chat_id, "payload": data, "created_at": now}
+        for user_id, seq in seqs.items()
+    ])
+
+    prune = [
+        {"user_id": user_id, "upto": seq - Config.UPDATES_LOG_SIZE}
+        for user_id, seq in seqs.items()
+        if seq % PRUNE_EVERY == 0 and seq > Config.UPDATES_LOG_SIZE
+    ]
+    if prune:
+        await session.execute(_PRUNE, prune)
+
+    return {"payload": payload, "date": now, "seqs": seqs}
+
+
+def push(recorded: dict):
+    """Send committed updates to the users' live sockets."""
+    payload = recorded["payload"]
+    date = recorded["date"].isoformat()
+    if "broadcast_chat_id" in recorded:
+        channel_broadcaster.post(recorded["broadcast_chat_id"], {**payload, "date": date})
+        return
+    seqs = recorded["seqs"]
+    if seqs:
+        # One event for all members, each copy with the member's own seq
+        event_bus.publish_to_users(list(seqs), {**payload, "date": date}, seqs=seqs)
+
+
+async def current_seq(session: AsyncSession, user_id: int) -> int:
+    result = await session.execute(select(User.update_seq).where(User.id == user_id))
+    return result.scalar_one_or_none() or 0
+
+
+async def _changed_chats(session: AsyncSession, user_id: int, since: Optional[datetime],
+                         unlogged_only: bool = False) -> list:
+    """Compact state of the user's chats changed since a point in time.
+
+    `unlogged_only` limits it to channels and large groups, whose events
+    are not in the user's log.
+    """
+    query = (
+        select(Chat, chat_members.c.read_seq, chat_members.c.last_read_message_id)
+        .join(chat_members, chat_members.c.chat_id == Chat.id)
+        .where(chat_members.c.user_id == user_id)
+        .order_by(desc(Chat.updated_at))
+    )
+    if since is not None:
+        query = query.where(Chat.updated_at > since)
+    if unlogged_only:
+        query = query.where(_unlogged())
+    result = await session.execute(query)
+    return [
+        {
+            "id": chat.id,
+            "last_message_id": chat.last_message_id,
+            "last_message_at": chat.last_message_at,
+            "last_read_message_id": last_read_message_id,
+            "unread_count": unread_count(chat.message_seq, read_seq),
+            "updated_at": chat.updated_at
+        }
+        for chat, read_seq, last_read_message_id in result
+    ]
+
+
+async def get_difference(session: AsyncSession, user_id: int, since_seq: int,
+                         since_date: Optional[datetime] = None) -> dict:
+    """Updates after since_seq, or the chats changed since since_date.
+
+    The result has ``too_long`` set when the updates are no longer (or too
+    many to be) in the log; ``chats`` then lists the chats changed since
+    ``since_date`` (all chats without it). Otherwise ``chats`` lists the
+    channels and large groups changed since ``since_date``, whose events
+    are not logged.
+    """
+    seq = await current_seq(session, user_id)
+    unlogged = []
+    if since_date is not None:
+        unlogged = await _changed_chats(session, user_id, since_date, unlogged_only=True)
+    if since_seq == seq:
+        return {"seq": seq, "date": datetime.utcnow(), "too_long": False, "updates": [], "chats": unlogged}
+
+    rows = []
+    if 0 <= since_seq < seq:
+        result = await session.execute(
+            select(UserUpdate)
+            .where(UserUpdate.user_id == user_id)
+            .where(UserUpdate.seq > since_seq)
+            .order_by(UserUpdate.seq)
+            .limit(Config.UPDATES_DIFFERENCE_LIMIT + 1)
+        )
+        rows = result.scalars().all()
+
+    complete = (
+        rows
+        and rows[0].seq == since_seq + 1  # nothing pruned in between
+        and len(rows) <= Config.UPDATES_DIFFERENCE_LIMIT
+    )
+    if not complete:
+        return {
+            "seq": seq,
+            "date": datetime.utcnow(),
+            "too_long": True,
+            "chats": await _changed_chats(session, user_id, since_date)
+        }
+
+    return {
+        "seq": seq,
+        "date": rows[-1].created_at,
+        "too_long": False,
+        "updates": [
+            {**json.loads(row.payload), "seq": row.seq, "date": row.created_at.isoformat()}
+            for row in rows
+        ],
+        "chats": unlogged
+    }
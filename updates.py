@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from datetime import datetime
+
+import update_log
+from dependencies import get_current_user, get_read_db
+
+router = APIRouter()
+
+
+@router.get("/state")
+async def get_state(
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Current position of the user's update stream."""
+    seq = await update_log.current_seq(db, current_user["user_id"])
+    return {"seq": seq, "date": datetime.utcnow()}
+
+
+@router.get("/difference")
+async def get_difference(
+    seq: int,
+    date: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Updates after `seq` (the last one the client has seen).
+    
+    If the client is too far behind, `too_long` is set and `chats` lists
+    the chats changed since `date` instead; the client reloads those and
+    continues from the returned `seq`. Otherwise `chats` lists the channels
+    and large groups changed since `date`, whose events are not in the
+    stream.
+    """
+    return await update_log.get_difference(db, current_user["user_id"], seq, date)
@@ -0,0 +1,183 @@
+"""In-process cache of user rows.
+
+Profiles are read far more often than they change: every ``/api/users/me``,
+``/api/users/{id}`` and login looked the user up in SQLite. ``user_cache``
+keeps ``UserSnapshot``s, frozen copies of the rows detached from any
+session, in an LRU with a TTL (``Config.USER_CACHE_SIZE`` and
+``Config.USER_CACHE_TTL``), with a username -> id index beside it.
+
+Code that changes a user row calls ``user_changed`` (or ``user_updated``)
+after committing: the entry is dropped on every worker and the new snapshot
+written through on this one. The TTL bounds how stale a row changed by any
+other path can get.
+
+Usernames and emails found unused (``register``'s existence checks) are
+remembered for ``Config.USER_CACHE_NEGATIVE_TTL`` seconds, and forgotten as
+soon as a user takes them.
+"""
+import dataclasses
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from settings import Config
+from event_bus import event_bus
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """A users row as it was when cached."""
+    id: int
+    username: str
+    email: str
+    hashed_password: Optional[str]
+    display_name: str
+    avatar_url: Optional[str]
+    phone_number: Optional[str]
+    bio: Optional[str]
+    is_online: bool
+    last_seen: Optional[datetime]
+    created_at: Optional[datetime]
+
+    @classmethod
+    def from_user(cls, user) -> "UserSnapshot":
+        return cls(**{field.name: getattr(user, field.name) for field in dataclasses.fields(cls)})
+
+
+class UserCache:
+    """LRU + TTL cache of user snapshots, with a negative cache of free names."""
+
+    def __init__(self, max_entries: int, ttl: float, negative_ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[int, Tuple[UserSnapshot, float]]" = OrderedDict()  # snapshot, expires
+        self._ids_by_username: Dict[str, int] = {}
+        self._absent: "OrderedDict[Tuple[str, str], float]" = OrderedDict()  # (field, value) -> expires
+        self._changes = 0  # user_changed events seen, see fill()
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.negative_misses = 0
+
+    def get(self, user_id: int) -> Optional[UserSnapshot]:
+        """Cached snapshot, or None if unknown."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            snapshot, expires = entry
+            if time.monotonic() < expires:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return snapshot
+            self.invalidate(user_id)
+        self.misses += 1
+        return None
+
+    def get_by_username(self, username: str) -> Optional[UserSnapshot]:
+        user_id = self._ids_by_username.get(username)
+        if user_id is None:
+            self.misses += 1
+            return None
+        return self.get(user_id)
+
+    def put(self, user) -> UserSnapshot:
+        """Cache a user (ORM object or snapshot); returns the snapshot."""
+        snapshot = user if isinstance(user, UserSnapshot) else UserSnapshot.from_user(user)
+        self.invalidate(snapshot.id)
+        self._entries[snapshot.id] = (snapshot, time.monotonic() + self.ttl)
+        self._ids_by_username[snapshot.username] = snapshot.id
+        self._absent.pop(("username", snapshot.username), None)
+        self._absent.pop(("email", snapshot.email), None)
+        while len(self._entries) > self.max_entries:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._ids_by_username.pop(evicted.username, None)
+        return snapshot
+
+    def begin_fill(self) -> int:
+        """Token to pass to fill() after reading a user from the database."""
+        return self._changes
+
+    def fill(self, user, token: int) -> UserSnapshot:
+        """Cache a user read from the database, unless some user changed meanwhile.
+
+        The read may have started before the change was committed.
+        """
+        snapshot = UserSnapshot.from_user(user)
+        if token == self._changes:
+            self.put(snapshot)
+        return snapshot
+
+    def peek(self, user_id: int) -> Optional[UserSnapshot]:
+        """Cached snapshot, without counting a lookup or refreshing its TTL."""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._ids_by_username.pop(entry[0].username, None)
+
+    def is_absent(self, field: str, value: str) -> bool:
+        """Whether no user had this username/email a moment ago."""
+        expires = self._absent.get((field, value))
+        if expires is not None and time.monotonic() < expires:
+            self.negative_hits += 1
+            return True
+        self.negative_misses += 1
+        return False
+
+    def mark_absent(self, field: str, value: str):
+        self._absent[(field, value)] = time.monotonic() + self.negative_ttl
+        self._absent.move_to_end((field, value))
+        while len(self._absent) > self.max_entries:
+            self._absent.popitem(last=False)
+
+    def taken(self, username: str, email: str):
+        self._absent.pop(("username", username), None)
+        self._absent.pop(("email", email), None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        negative_lookups = self.negative_hits + self.negative_misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "absent_entries": len(self._absent),
+            "negative_hit_rate": self.negative_hits / negative_lookups if negative_lookups else 0.0
+        }
+
+
+user_cache = UserCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL, Config.USER_CACHE_NEGATIVE_TTL)
+
+
+def _on_user_changed(data: dict):
+    user_cache._changes += 1
+    user_cache.invalidate(data["user_id"])
+    if "username" in data:
+        user_cache.taken(data["username"], data["email"])
+
+
+event_bus.on("user_changed", _on_user_changed)
+
+
+def user_changed(user, created: bool = False) -> UserSnapshot:
+    """Drop a changed (or new) user on every worker and cache it on this one."""
+    data = {"user_id": user.id}
+    if created:
+        data.update(username=user.username, email=user.email)
+    event_bus.publish("user_changed", data)
+    return user_cache.put(user)
+
+
+def user_updated(user_id: int, **changes):
+    """Like user_changed, for an UPDATE of some columns of a user."""
+    snapshot = user_cache.peek(user_id)
+    event_bus.publish("user_changed", {"user_id": user_id})
+    if snapshot is not None:
+        user_cache.put(dataclasses.replace(snapshot, **changes))
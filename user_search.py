@@ -0,0 +1,161 @@
+"""Indexed user search.
+
+Usernames and display names are compared through their normalized forms,
+``User.username_key`` and ``User.display_name_key`` (casefolded, accents
+stripped, see ``models.search_key``). Results come in tiers, each read with
+an index and a LIMIT, so the cost of a page does not grow with the number
+of users:
+
+1. exact: either key equals the query (key indexes)
+2. username prefix, by username (range scan of the username_key index)
+3. display name prefix, by display name (range scan of display_name_key)
+4. substring of either key, by id (``users_fts``, an FTS5 trigram index;
+   queries of three characters or more)
+
+A user appears once, in the first tier that matches. The cursor of the next
+page records the tier and the position in it.
+"""
+import base64
+import binascii
+import json
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, column, inspect, or_, select, table, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import User, search_key
+
+TABLE = "users_fts"
+
+EXACT, USERNAME_PREFIX, DISPLAY_NAME_PREFIX, SUBSTRING = range(4)
+
+# Trigrams need three characters
+SUBSTRING_MIN_LENGTH = 3
+
+users_fts = table(TABLE, column("rowid"))
+
+_DDL = [
+    f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+    "username_key, display_name_key, content='users', content_rowid='id', tokenize='trigram')",
+    f"CREATE TRIGGER {TABLE}_ai AFTER INSERT ON users BEGIN "
+    f"INSERT INTO {TABLE}(rowid, username_key, display_name_key) "
+    "VALUES (new.id, new.username_key, new.display_name_key); END",
+    f"CREATE TRIGGER {TABLE}_ad AFTER DELETE ON users BEGIN "
+    f"INSERT INTO {TABLE}({TABLE}, rowid, username_key, display_name_key) "
+    "VALUES ('delete', old.id, old.username_key, old.display_name_key); END",
+    # Only renames: users rows are also updated for presence and update seqs
+    f"CREATE TRIGGER {TABLE}_au AFTER UPDATE OF username_key, display_name_key ON users BEGIN "
+    f"INSERT INTO {TABLE}({TABLE}, rowid, username_key, display_name_key) "
+    "VALUES ('delete', old.id, old.username_key, old.display_name_key); "
+    f"INSERT INTO {TABLE}(rowid, username_key, display_name_key) "
+    "VALUES (new.id, new.username_key, new.display_name_key); END",
+]
+
+
+def ensure_index(conn) -> bool:
+    """Create the trigram index and its triggers if missing; True if it was created."""
+    if TABLE in inspect(conn).get_table_names():
+        return False
+    for ddl in _DDL:
+        conn.execute(text(ddl))
+    return True
+
+
+def rebuild(conn):
+    """Re-index every user from the users table."""
+    conn.execute(text(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')"))
+
+
+def encode_cursor(tier: int, key: str, user_id: int) -> str:
+    """Opaque cursor after a result of a tier."""
+    raw = json.dumps([tier, key, user_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str, int]:
+    """Parse a cursor produced by encode_cursor; raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        tier, key, user_id = json.loads(base64.urlsafe_b64decode(padded))
+        if tier not in (EXACT, USERNAME_PREFIX, DISPLAY_NAME_PREFIX, SUBSTRING):
+            raise ValueError(tier)
+        return tier, str(key), int(user_id)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(cursor) from e
+
+
+def _prefix_of(key_column, query: str, upper: str):
+    return and_(key_column >= query, key_column < upper)
+
+
+def _tier_statement(tier: int, query: str, after: Optional[Tuple[str, int]], limit: int):
+    """Select the next users of one tier and their position in it."""
+    upper = query + "\U0010ffff"  # sorts after every key starting with query
+    username_prefix = _prefix_of(User.username_key, query, upper)
+    display_name_prefix = _prefix_of(User.display_name_key, query, upper)
+
+    if tier == EXACT:
+        statement = (
+            select(User, User.username_key)
+            .where(or_(User.username_key == query, User.display_name_key == query))
+            .order_by(User.id)
+        )
+        if after is not None:
+            statement = statement.where(User.id > after[1])
+    elif tier in (USERNAME_PREFIX, DISPLAY_NAME_PREFIX):
+        if tier == USERNAME_PREFIX:
+            key_column, seen = User.username_key, User.display_name_key == query
+        else:
+            key_column, seen = User.display_name_key, username_prefix
+        statement = (
+            select(User, key_column)
+            .where(key_column < upper)
+            .where(~seen)
+            .order_by(key_column, User.id)
+        )
+        # The lower bound is where the index range scan starts
+        if after is None:
+            statement = statement.where(key_column > query)
+        else:
+            key, user_id = after
+            statement = statement.where(key_column >= key).where(
+                or_(key_column > key, User.id > user_id))
+    else:
+        match = '"' + query.replace('"', '""') + '"'
+        statement = (
+            select(User, User.username_key)
+            .join(users_fts, users_fts.c.rowid == User.id)
+            .where(text(f"{TABLE} MATCH :match").bindparams(match=match))
+            .where(~username_prefix, ~display_name_prefix)
+            .order_by(users_fts.c.rowid)
+        )
+        if after is not None:
+            statement = statement.where(users_fts.c.rowid > after[1])
+    return statement.limit(limit)
+
+
+async def search(session: AsyncSession, query: str, limit: int,
+                 cursor: Optional[str] = None) -> Tuple[List[User], Optional[str]]:
+    """One page of users matching a query and the cursor of the next page, if any."""
+    query = search_key(query.strip())
+    if not query:
+        return [], None
+
+    tier, after = EXACT, None
+    if cursor:
+        tier, key, user_id = decode_cursor(cursor)
+        after = (key, user_id)
+    last_tier = SUBSTRING if len(query) >= SUBSTRING_MIN_LENGTH else DISPLAY_NAME_PREFIX
+
+    users, positions = [], []
+    while tier <= last_tier:
+        # One extra row tells whether the page is the last one
+        wanted = limit + 1 - len(users)
+        result = await session.execute(_tier_statement(tier, query, after, wanted))
+        for user, key in result.all():
+            users.append(user)
+            positions.append((tier, key, user.id))
+        if len(users) > limit:
+            return users[:limit], encode_cursor(*positions[limit - 1])
+        tier, after = tier + 1, None
+    return users, None
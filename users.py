@@ -1,33 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
+import hashlib
+import json
 
 from main import async_session
 from models import User
-from schemas import UserResponse
-from dependencies import get_current_user, get_db
-from auth import get_user_by_id, get_user_by_username, set_user_online_status
+from schemas import UserResponse, UserBatchRequest
+from settings import Config
+from dependencies import get_current_user, get_db, get_read_db
+from auth import get_user_by_id, get_users_by_ids, set_user_online_status
+from message_cache import message_cache
+from user_cache import UserSnapshot, user_changed
+from presence_store import presence_store
+import user_search
+import ws_protocol
 
 router = APIRouter()
 
 
 @router.get("/", response_model=List[UserResponse])
 async def search_users(
+    response: Response,
     query: str = "",
+    limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Search users by username or display name."""
-    result = await db.execute(
-        select(User)
-        .where(User.username.contains(query) | User.display_name.contains(query))
-        .limit(20)
-    )
-    users = result.scalars().all()
+    """Search users by username or display name.
+    
+    Exact matches come first, then username and display name prefixes,
+    then other substrings (see user_search.py). An empty query matches
+    nobody. The next page is addressed by the opaque cursor in the
+    X-Next-Cursor response header.
+    """
+    limit = min(max(1, limit), 100)
+    try:
+        users, next_cursor = await user_search.search(db, query, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    return users
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [presence_store.current(UserSnapshot.from_user(user)) for user in users]
 
 
 @router.get("/me", response_model=UserResponse)
@@ -42,11 +59,86 @@ async def get_current_user_info(
     return user
 
 
+def _batch_response(request: Request, users: Dict[int, UserSnapshot], user_ids: List[int],
+                    format: Optional[str]) -> Response:
+    """Users in request order, ids that matched nobody, and an ETag of both.
+    
+    The compact format sends the users as rows of values in the order of
+    `fields`, with timestamps as integers (milliseconds, UTC).
+    """
+    found = [users[user_id] for user_id in user_ids if user_id in users]
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if format == "compact":
+        fields = list(UserResponse.model_fields)
+        body = {
+            "fields": fields,
+            "rows": [ws_protocol.compact([getattr(user, field) for field in fields]) for user in found],
+            "missing": missing
+        }
+    else:
+        body = {
+            "users": [UserResponse.model_validate(user).model_dump(mode="json") for user in found],
+            "missing": missing
+        }
+    content = json.dumps(body, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+async def _get_batch(request: Request, user_ids: List[int], format: Optional[str], db: AsyncSession) -> Response:
+    user_ids = list(dict.fromkeys(user_ids))
+    if len(user_ids) > Config.USER_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {Config.USER_BATCH_MAX_IDS} ids")
+    users = await get_users_by_ids(db, user_ids)
+    return _batch_response(request, users, user_ids, format)
+
+
+@router.get("/batch")
+async def get_users_batch(
+    request: Request,
+    ids: str,
+    format: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Get many users by ID, e.g. the senders of a history page.
+    
+    `ids` is a comma-separated list (POST /batch takes larger ones). Users
+    come in the order asked for; unknown ids are listed in `missing`. A
+    client sending the ETag of its last result in If-None-Match gets a 304
+    if nothing changed. `format=compact` sends rows of values instead of
+    objects.
+    """
+    try:
+        user_ids = [int(user_id) for user_id in ids.split(",") if user_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid ids")
+    return await _get_batch(request, user_ids, format, db)
+
+
+@router.post("/batch")
+async def post_users_batch(
+    request: Request,
+    batch: UserBatchRequest,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Get many users by ID; same as GET /batch, for id lists too long for a URL."""
+    return await _get_batch(request, batch.ids, batch.format, db)
+
+
 @router.get("/{user_id}", response_model=UserResponse)
 async def get_user(
     user_id: int,
     current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Get user by ID."""
     user = await get_user_by_id(db, user_id)
@@ -63,7 +155,7 @@ async def update_profile(
     db: AsyncSession = Depends(get_db)
 ):
     """Update current user's profile."""
-    user = await get_user_by_id(db, current_user["user_id"])
+    user = await db.get(User, current_user["user_id"])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -74,17 +166,18 @@ async def update_profile(
     
     user.updated_at = datetime.utcnow()
     await db.commit()
+    if display_name:
+        message_cache.rename_sender(user.id, display_name)
     await db.refresh(user)
     
-    return {"message": "Profile updated successfully", "user": user}
+    return {"message": "Profile updated successfully", "user": UserResponse.model_validate(presence_store.current(user_changed(user)))}
 
 
 @router.post("/online")
 async def set_online_status(
     is_online: bool,
-    current_user: dict = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    current_user: dict = Depends(get_current_user)
 ):
-    """Set user's online status."""
-    await set_user_online_status(db, current_user["user_id"], is_online)
+    """Set user's online status (for clients without a WebSocket)."""
+    set_user_online_status(current_user["user_id"], is_online)
     return {"message": "Status updated"}
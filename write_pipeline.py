@@ -0,0 +1,252 @@
+"""Single-writer group-commit pipeline for hot SQLite writes.
+
+Request handlers hand write operations to ``write_pipeline`` instead of
+committing on their own session. One writer task collects whatever is
+queued within ``Config.WRITE_BATCH_WINDOW_MS`` (at most
+``Config.WRITE_BATCH_MAX_SIZE`` operations), applies the batch in a single
+transaction and resolves each caller's future with the operation's result.
+If a batch fails, its operations are retried one by one so a single bad
+write only fails its own caller.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Iterable, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import User, Chat, Message, MessageStatus
+from settings import Config
+import chat_summary
+import read_state
+import update_log
+from message_cache import message_cache, serialize, reply_preview
+from user_cache import UserSnapshot
+
+logger = logging.getLogger(__name__)
+
+WriteOp = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WritePipeline:
+    """Queue of write operations drained by one group-committing task."""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._session_factory = None
+        # Stats
+        self.batches = 0
+        self.operations = 0
+        self.failed = 0
+        self.max_batch_size = 0
+        self._commit_latencies = deque(maxlen=1000)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, session_factory):
+        """Start the writer task."""
+        if self._task is None:
+            self._session_factory = session_factory
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Wait for queued writes to be committed, then stop the writer."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def submit(self, op: WriteOp) -> Any:
+        """Queue a write and wait for the batch containing it to commit."""
+        if self._task is None:
+            raise RuntimeError("Write pipeline is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        window = Config.WRITE_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + window
+            while len(batch) < Config.WRITE_BATCH_MAX_SIZE:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _commit(self, batch):
+        started = time.perf_counter()
+        try:
+            async with self._session_factory() as session:
+                results = [await op(session) for op, _ in batch]
+                await session.commit()
+        except Exception:
+            logger.warning(f"Write batch of {len(batch)} failed, retrying one by one")
+            for item in batch:
+                await self._commit_one(item)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self._commit_latencies.append(time.perf_counter() - started)
+
+    async def _commit_one(self, item):
+        op, future = item
+        try:
+            async with self._session_factory() as session:
+                result = await op(session)
+                await session.commit()
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._commit_latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "operations": self.operations,
+            "failed": self.failed,
+            "avg_batch_size": self.operations / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "commit_ms_p50": percentile(0.5),
+            "commit_ms_p99": percentile(0.99),
+            "commit_ms_max": latencies[-1] * 1000 if latencies else 0.0
+        }
+
+    # Operations
+
+    async def insert_message(self, chat_id: int, sender_id: int, content: str,
+                             content_type: str = "text", reply_to_id: Optional[int] = None) -> Tuple[int, int]:
+        """Insert a message and update the chat state; returns (id, seq).
+
+        The new_message update is pushed to the chat members once committed.
+        """
+        async def op(session: AsyncSession):
+            message = Message(
+                chat_id=chat_id,
+                sender_id=sender_id,
+                content=content,
+                content_type=content_type,
+                status=MessageStatus.SENT,
+                reply_to_id=reply_to_id,
+                seq=await read_state.next_message_seq(session, chat_id)
+            )
+            session.add(message)
+            await session.flush()
+
+            # Update chat summary (also bumps updated_at)
+            await chat_summary.record_message(session, message)
+
+            # Sending a message marks the chat as read for the sender
+            await read_state.mark_read(session, chat_id, sender_id, message.id, message.seq)
+
+            recorded = await update_log.record_chat_event(session, chat_id, {
+                "type": "new_message",
+                "id": message.id,
+                "chat_id": chat_id,
+                "sender_id": sender_id,
+                "content": content,
+                "content_type": content_type,
+                "reply_to_id": reply_to_id,
+                "created_at": message.created_at
+            })
+
+            # Hot chats get the message appended to their cached history
+            entry = None
+            if message_cache.contains(chat_id):
+                sender_name = (await session.execute(
+                    select(User.display_name).where(User.id == sender_id)
+                )).scalar_one_or_none()
+                reply_to_content = None
+                if reply_to_id is not None:
+                    reply_to_content = reply_preview((await session.execute(
+                        select(Message.content).where(Message.id == reply_to_id)
+                    )).scalar_one_or_none())
+                entry = serialize(message, sender_name, reply_to_content)
+            return message.id, message.seq, recorded, entry
+
+        message_id, seq, recorded, entry = await self.submit(op)
+        message_cache.append(chat_id, entry)
+        update_log.push(recorded)
+        return message_id, seq
+
+    async def touch_chat(self, chat_id: int):
+        """Bump a chat's updated_at so it moves to the top of chat lists."""
+        async def op(session: AsyncSession):
+            await session.execute(
+                update(Chat).where(Chat.id == chat_id).values(updated_at=datetime.utcnow())
+            )
+
+        return await self.submit(op)
+
+    async def set_message_status(self, message_ids: Iterable[int], status: MessageStatus) -> int:
+        """Update the delivery status of messages; returns the number changed."""
+        message_ids = list(message_ids)
+
+        async def op(session: AsyncSession):
+            result = await session.execute(
+                update(Message).where(Message.id.in_(message_ids)).values(status=status)
+            )
+            return result.rowcount
+
+        changed = await self.submit(op)
+        message_cache.set_status(message_ids, status.value)
+        return changed
+
+    async def insert_user(self, **columns) -> UserSnapshot:
+        """Insert a user; raises IntegrityError if the username or email is taken."""
+        async def op(session: AsyncSession):
+            user = User(**columns)
+            session.add(user)
+            await session.flush()
+            return UserSnapshot.from_user(user)
+
+        return await self.submit(op)
+
+    async def set_password_hash(self, user_id: int, hashed_password: str):
+        """Replace a user's password hash (e.g. rehashed at a new cost)."""
+        async def op(session: AsyncSession):
+            await session.execute(
+                update(User).where(User.id == user_id).values(hashed_password=hashed_password)
+            )
+
+        return await self.submit(op)
+
+
+write_pipeline = WritePipeline()
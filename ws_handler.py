@@ -1,90 +1,188 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import Dict, Set
-import json
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+import logging
+import time
 from datetime import datetime
+from typing import Optional
+
+from main import async_read_session
+from dependencies import websocket_principal
+from schemas import MessageCreate
+from membership import is_member
+from write_pipeline import write_pipeline
+from read_state import read_cursors
+from ws_hub import hub, OutboundEvent
+from event_bus import event_bus
+from presence import presence_notifier
+from presence_store import presence_store
+from typing_state import typing_notifier
+from heartbeat import heartbeat
+import ws_protocol
+import update_log
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-# Active connections
-active_connections: Dict[int, WebSocket] = {}
-online_users: Set[int] = set()
+PONG = OutboundEvent({"type": "pong"})
+
+
+def _int_list(value) -> list:
+    """User ids from a client frame, ignoring anything that isn't an int."""
+    if not isinstance(value, list):
+        return []
+    return [v for v in value if isinstance(v, int)]
+
+
+def notify_user_status(user_id: int, is_online: bool):
+    """Report that a user's first/last socket on this worker opened/closed.
+    
+    The event bus turns this into a cluster-wide status change once no
+    worker has a socket of the user left; presence_notifier then delivers
+    it, debounced and batched, to interested users.
+    """
+    event_bus.set_local_presence(user_id, is_online)
+
+
+def connection_closed(conn):
+    """Forget a socket; the user goes offline with their last device."""
+    heartbeat.remove(conn)
+    if hub.unregister(conn):
+        notify_user_status(conn.user_id, False)
+        presence_notifier.unsubscribe(conn.user_id)
+        typing_notifier.clear_user(conn.user_id)
 
 
-async def notify_user_status(user_id: int, is_online: bool):
-    """Notify all connections about user status change."""
-    message = json.dumps({
-        "type": "status_change",
-        "user_id": user_id,
-        "is_online": is_online
-    })
+# Sockets that stop answering pings are dropped the same way
+heartbeat.on_reap(connection_closed)
+
+
+async def send_message(user_id: int, frame: dict) -> dict:
+    """Persist a message sent over the socket; returns the ack frame.
+    
+    Goes through the same write pipeline as POST /api/messages/, which
+    pushes the new_message update to every member's live connections.
+    `client_id` is echoed back so the client can match the ack.
+    """
+    client_id = frame.get("client_id")
+    try:
+        data = MessageCreate(**{k: frame[k] for k in MessageCreate.model_fields if k in frame})
+    except ValidationError:
+        return {"type": "error", "client_id": client_id, "detail": "Invalid message"}
+    
+    async with async_read_session() as session:
+        if not await is_member(session, data.chat_id, user_id):
+            return {"type": "error", "client_id": client_id, "detail": "Not a member of this chat"}
+    
+    try:
+        message_id, _ = await write_pipeline.insert_message(
+            chat_id=data.chat_id,
+            sender_id=user_id,
+            content=data.content,
+            content_type=data.content_type,
+            reply_to_id=data.reply_to_id
+        )
+    except Exception:
+        logger.exception("Failed to store WebSocket message")
+        return {"type": "error", "client_id": client_id, "detail": "Message not sent"}
     
-    for connection in active_connections.values():
-        try:
-            await connection.send_text(message)
-        except Exception:
-            pass
+    return {
+        "type": "message_ack",
+        "client_id": client_id,
+        "id": message_id,
+        "chat_id": data.chat_id
+    }
 
 
 @router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    """WebSocket endpoint for real-time messaging."""
-    await websocket.accept()
-    active_connections[user_id] = websocket
-    online_users.add(user_id)
+async def websocket_endpoint(websocket: WebSocket, user_id: int, token: Optional[str] = None,
+                             since_seq: Optional[int] = None, since_date: Optional[datetime] = None):
+    """WebSocket endpoint for real-time messaging.
+    
+    A reconnecting client passes the last update `since_seq` (and `since_date`)
+    it has seen and first receives a `difference` frame with what it missed.
+    Live updates may arrive before it; clients apply updates by seq and
+    drop the ones they already have.
+    
+    The handshake carries the user's access token, as the `token` query
+    parameter or an Authorization header; it is refused otherwise.
+    """
+    principal = websocket_principal(websocket, token)
+    if principal is None or principal["user_id"] != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    protocol = ws_protocol.negotiate(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=protocol)
+    conn, came_online = hub.register(websocket, user_id, protocol)
+    heartbeat.add(conn)
     
-    # Notify others that user is online
-    await notify_user_status(user_id, True)
+    # Notify others that user is online (first device only)
+    if came_online:
+        notify_user_status(user_id, True)
+    
+    if since_seq is not None:
+        async with async_read_session() as session:
+            difference = await update_log.get_difference(session, user_id, since_seq, since_date)
+        conn.send(OutboundEvent({"type": "difference", **difference}))
     
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            conn.last_seen = time.monotonic()
+            message = ws_protocol.decode(frame.get("text") or frame.get("bytes"), protocol)
             
             # Handle different message types
             msg_type = message.get("type")
             
-            if msg_type == "message":
-                # Forward message to recipient
-                recipient_id = message.get("recipient_id")
-                if recipient_id in active_connections:
-                    await active_connections[recipient_id].send_text(json.dumps({
-                        "type": "new_message",
-                        "chat_id": message.get("chat_id"),
-                        "sender_id": user_id,
-                        "content": message.get("content"),
-                        "timestamp": datetime.utcnow().isoformat()
-                    }))
+            if msg_type == "ping":
+                conn.send(PONG)
+            
+            elif msg_type == "pong":
+                # Answer to a heartbeat ping; last_seen is already updated
+                pass
+            
+            elif msg_type == "message":
+                # Store the message; members get it as a new_message update
+                if isinstance(message.get("chat_id"), int):
+                    typing_notifier.clear_user(user_id, message["chat_id"])
+                conn.send(OutboundEvent(await send_message(user_id, message)))
             
             elif msg_type == "typing":
-                # Send typing indicator
-                recipient_id = message.get("recipient_id")
-                if recipient_id in active_connections:
-                    await active_connections[recipient_id].send_text(json.dumps({
-                        "type": "typing",
-                        "user_id": user_id
-                    }))
+                # Delivered to the chat members by the typing timer
+                chat_id = message.get("chat_id")
+                if isinstance(chat_id, int):
+                    typing_notifier.typing(chat_id, user_id, message.get("is_typing", True) is not False)
+            
+            elif msg_type == "subscribe_presence":
+                # Follow the presence of users outside the user's chats
+                presence_notifier.subscribe(user_id, _int_list(message.get("user_ids")))
+            
+            elif msg_type == "unsubscribe_presence":
+                presence_notifier.unsubscribe(user_id, _int_list(message.get("user_ids")))
             
             elif msg_type == "read":
-                # Mark messages as read
+                # Mark messages as read (written with the next batched flush)
                 chat_id = message.get("chat_id")
-                # In a real app, update database here
-                await websocket.send_text(json.dumps({
+                message_id = message.get("message_id")
+                if isinstance(chat_id, int) and isinstance(message_id, int):
+                    read_cursors.advance(chat_id, user_id, message_id)
+                # Every device of the user gets it, so they all drop the badge
+                event_bus.publish_to_users([user_id], {
                     "type": "read_receipt",
                     "chat_id": chat_id,
+                    "message_id": message_id,
                     "user_id": user_id
-                }))
+                })
     
     except WebSocketDisconnect:
-        # Remove connection
-        if user_id in active_connections:
-            del active_connections[user_id]
-        online_users.discard(user_id)
-        
-        # Notify others that user is offline
-        await notify_user_status(user_id, False)
+        pass
+    finally:
+        connection_closed(conn)
 
 
 @router.get("/online")
 async def get_online_users():
-    """Get list of online users."""
-    return {"online_users": list(online_users)}
+    """Get list of online users (across all workers)."""
+    return {"online_users": presence_store.online_user_ids()}
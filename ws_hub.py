@@ -0,0 +1,278 @@
+"""WebSocket connection hub.
+
+Every connection gets a bounded outbound queue, drained by a short-lived
+writer task while it has events, so fanning an event out is O(recipients)
+enqueue operations and never waits on a client's network I/O. What happens when a queue is full is set
+by ``Config.WS_SLOW_CONSUMER_POLICY``:
+
+- ``drop_oldest``: discard the oldest queued event
+- ``coalesce``: replace a queued event with the same coalesce key (e.g. an
+  older status change of the same user), otherwise drop the oldest
+- ``disconnect``: close the connection
+
+Connections that negotiated a compact format (see ``ws_protocol``) get
+everything queued within ``Config.WS_BATCH_WINDOW_MS`` in one frame.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import deque
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from fastapi import WebSocket
+
+from settings import Config
+import ws_protocol
+
+logger = logging.getLogger(__name__)
+
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+class OutboundEvent:
+    """An event queued for one or more connections, serialized once per format."""
+
+    __slots__ = ("payload", "coalesce_key", "_text", "_encoded")
+
+    def __init__(self, payload: dict, coalesce_key: Optional[Hashable] = None):
+        self.payload = payload
+        self.coalesce_key = coalesce_key
+        self._text = None
+        self._encoded = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.payload, default=str)
+        return self._text
+
+    def encoded(self, protocol: str):
+        """The event in a compact format (see ws_protocol)."""
+        if self._encoded is None:
+            self._encoded = {}
+        data = self._encoded.get(protocol)
+        if data is None:
+            data = self._encoded[protocol] = ws_protocol.encode(self.payload, protocol)
+        return data
+
+
+class SequencedEvent:
+    """One user's copy of a shared event, carrying their own ``seq``.
+
+    The shared event is still serialized once per format; each copy only
+    appends its seq to that encoding.
+    """
+
+    __slots__ = ("event", "seq")
+
+    def __init__(self, event: OutboundEvent, seq: int):
+        self.event = event
+        self.seq = seq
+
+    @property
+    def coalesce_key(self) -> Optional[Hashable]:
+        return self.event.coalesce_key
+
+    @property
+    def payload(self) -> dict:
+        return {**self.event.payload, "seq": self.seq}
+
+    @property
+    def text(self) -> str:
+        return ws_protocol.add_key(self.event.text, None, "seq", self.seq)
+
+    def encoded(self, protocol: str):
+        return ws_protocol.add_key(self.event.encoded(protocol), protocol, "seq", self.seq)
+
+
+class Connection:
+    """One WebSocket with its outbound queue.
+
+    Idle connections hold no task and no queue: both are created when an
+    event is queued and dropped once it has been written, so the per-socket
+    cost is this record (``__slots__``) and the WebSocket itself.
+    """
+
+    __slots__ = (
+        "hub", "websocket", "user_id", "conn_id", "protocol", "queue", "closed",
+        "last_seen", "hb_slot", "hb_rounds", "_flusher"
+    )
+
+    def __init__(self, hub: "ConnectionHub", websocket: WebSocket, user_id: int, conn_id: int,
+                 protocol: Optional[str] = None):
+        self.hub = hub
+        self.websocket = websocket
+        self.user_id = user_id
+        self.conn_id = conn_id
+        self.protocol = protocol  # None: one JSON text frame per event
+        self.queue: Optional[deque] = None  # created on demand
+        self.closed = False
+        self.last_seen = time.monotonic()  # last frame from the client
+        self.hb_slot = -1  # heartbeat wheel position (see heartbeat.py)
+        self.hb_rounds = 0
+        self._flusher: Optional[asyncio.Task] = None
+
+    def send(self, event: OutboundEvent):
+        """Queue an event for this connection without waiting."""
+        if self.closed:
+            return
+        if self.queue is None:
+            self.queue = deque()
+        elif len(self.queue) >= self.hub.queue_size:
+            if not self.hub.on_queue_full(self, event):
+                return
+        self.queue.append(event)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        """Write queued events until the queue is empty, then go idle."""
+        try:
+            if self.protocol is None:
+                while self.queue:
+                    event = self.queue.popleft()
+                    await self.websocket.send_text(event.text)
+                    self.hub.frames_sent += 1
+            else:
+                # Let events pile up for a moment, then send them as one frame
+                await asyncio.sleep(Config.WS_BATCH_WINDOW_MS / 1000)
+                while self.queue:
+                    events = [event.encoded(self.protocol) for event in self.queue]
+                    self.queue.clear()
+                    frame = ws_protocol.encode_batch(events, self.protocol)
+                    if isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+                    self.hub.frames_sent += 1
+                    self.hub.batched_events += len(events)
+            self.queue = None
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # The socket is gone; the receive loop will notice and unregister
+            self.closed = True
+            self.queue = None
+        finally:
+            self._flusher = None
+
+    def cancel(self):
+        """Stop sending; queued events are dropped."""
+        self.closed = True
+        self.queue = None
+        if self._flusher is not None:
+            self._flusher.cancel()
+
+    async def close(self, code: int = 1000):
+        """Stop the writer and close the socket."""
+        self.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionHub:
+    """Registry of live connections and fan-out entry point."""
+
+    def __init__(self, queue_size: int, policy: str):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        # A user can have many live sockets (one per device)
+        self.connections: Dict[int, Connection] = {}  # conn_id -> connection
+        self.by_user: Dict[int, Tuple[Connection, ...]] = {}  # user_id -> connections
+        self._conn_ids = itertools.count(1)
+        # Stats
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self.frames_sent = 0
+        self.batched_events = 0
+
+    def register(self, websocket: WebSocket, user_id: int,
+                 protocol: Optional[str] = None) -> Tuple[Connection, bool]:
+        """Add an accepted socket; returns it and whether the user came online."""
+        conn = Connection(self, websocket, user_id, next(self._conn_ids), protocol)
+        self.connections[conn.conn_id] = conn
+        # Tuples: most users have one device and a dict per user costs more
+        devices = self.by_user.get(user_id, ()) + (conn,)
+        self.by_user[user_id] = devices
+        return conn, len(devices) == 1
+
+    def unregister(self, conn: Connection) -> bool:
+        """Remove a connection; returns True if it was the user's last one."""
+        if self.connections.pop(conn.conn_id, None) is None:
+            return False
+        conn.cancel()
+        devices = tuple(c for c in self.by_user[conn.user_id] if c is not conn)
+        if devices:
+            self.by_user[conn.user_id] = devices
+            return False
+        del self.by_user[conn.user_id]
+        return True
+
+    def get(self, conn_id: int) -> Optional[Connection]:
+        return self.connections.get(conn_id)
+
+    def user_connections(self, user_id: int) -> Iterable[Connection]:
+        return self.by_user.get(user_id, ())
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.by_user
+
+    def online_user_ids(self):
+        return list(self.by_user)
+
+    def send_to_user(self, user_id: int, event: OutboundEvent):
+        """Queue an event for every live device of a user."""
+        for conn in self.by_user.get(user_id, ()):
+            conn.send(event)
+
+    def send_to_users(self, user_ids: Iterable[int], event: OutboundEvent):
+        for user_id in user_ids:
+            self.send_to_user(user_id, event)
+
+    def broadcast(self, event: OutboundEvent):
+        for conn in list(self.connections.values()):
+            conn.send(event)
+
+    def on_queue_full(self, conn: Connection, event: OutboundEvent) -> bool:
+        """Apply the slow consumer policy; returns True if event should be queued."""
+        if self.policy == "disconnect":
+            self.disconnected += 1
+            logger.info(f"Disconnecting slow consumer {conn.user_id}/{conn.conn_id}")
+            # The receive loop sees the close and unregisters the connection
+            conn.closed = True
+            asyncio.create_task(conn.close(code=1013))  # try again later
+            return False
+
+        if self.policy == "coalesce" and event.coalesce_key is not None:
+            for i, queued in enumerate(conn.queue):
+                if queued.coalesce_key == event.coalesce_key:
+                    del conn.queue[i]
+                    self.coalesced += 1
+                    return True
+
+        conn.queue.popleft()
+        self.dropped += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "online_users": len(self.by_user),
+            "queued_events": sum(len(c.queue) for c in self.connections.values() if c.queue),
+            "policy": self.policy,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "frames_sent": self.frames_sent,
+            "batched_events": self.batched_events
+        }
+
+
+hub = ConnectionHub(Config.WS_SEND_QUEUE_SIZE, Config.WS_SLOW_CONSUMER_POLICY)
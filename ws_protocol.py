@@ -0,0 +1,160 @@
+"""WebSocket wire formats.
+
+Clients pick a format with the WebSocket subprotocol header
+(``Sec-WebSocket-Protocol``). Without one, every event is sent as its own
+JSON text frame, as before. The compact formats:
+
+- ``liime.compact-json``: JSON text frames
+- ``liime.msgpack``: MessagePack binary frames (only offered when the
+  optional ``msgpack`` package is installed)
+
+use short keys (``KEYS``) and integer timestamps (milliseconds since the
+epoch, UTC), and each frame is an array of all events queued for the
+socket within ``Config.WS_BATCH_WINDOW_MS``. An event is encoded once per
+format and the bytes are reused for every recipient. Clients using a
+compact format send single events with the same short keys.
+"""
+import json
+import struct
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPACT_JSON = "liime.compact-json"
+MSGPACK = "liime.msgpack"
+
+# Short keys of the compact formats; keys not listed are sent unchanged
+KEYS = {
+    "type": "t",
+    "id": "i",
+    "chat_id": "c",
+    "user_id": "u",
+    "sender_id": "s",
+    "content": "b",
+    "content_type": "ct",
+    "reply_to_id": "r",
+    "message_id": "m",
+    "client_id": "k",
+    "created_at": "d",
+    "edited_at": "e",
+    "date": "dt",
+    "seq": "q",
+    "is_online": "o",
+    "is_typing": "y",
+    "changes": "ch",
+    "updates": "up",
+    "chats": "cs",
+    "too_long": "tl",
+    "detail": "x"
+}
+
+LONG_KEYS = {short: key for key, short in KEYS.items()}
+
+# Keys whose ISO 8601 string values are sent as integer timestamps
+TIME_KEYS = {"created_at", "edited_at", "date", "timestamp", "last_message_at", "updated_at"}
+
+
+def supported() -> List[str]:
+    """Compact formats this server can speak, preferred first."""
+    if msgpack is not None:
+        return [MSGPACK, COMPACT_JSON]
+    return [COMPACT_JSON]
+
+
+def negotiate(offered: Iterable[str]) -> Optional[str]:
+    """The first offered format we support, or None for plain JSON."""
+    available = supported()
+    for protocol in offered:
+        if protocol in available:
+            return protocol
+    return None
+
+
+def _timestamp(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)  # we store naive UTC
+    return int(value.timestamp() * 1000)
+
+
+def compact(value, key: Optional[str] = None):
+    """Shorten keys and turn timestamps into integers, recursively."""
+    if isinstance(value, dict):
+        return {KEYS.get(k, k): compact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [compact(v) for v in value]
+    if isinstance(value, datetime):
+        return _timestamp(value)
+    if key in TIME_KEYS and isinstance(value, str):
+        try:
+            return _timestamp(datetime.fromisoformat(value))
+        except ValueError:
+            return value
+    return value
+
+
+def expand(value):
+    """Undo the short keys of a frame received from a compact client."""
+    if isinstance(value, dict):
+        return {LONG_KEYS.get(k, k): expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    return value
+
+
+def decode(data: Union[str, bytes], protocol: Optional[str]) -> dict:
+    """Parse a frame received from a client."""
+    if protocol is None:
+        return json.loads(data)
+    if isinstance(data, bytes) and protocol == MSGPACK:
+        return expand(msgpack.unpackb(data))
+    return expand(json.loads(data))
+
+
+def encode(payload: dict, protocol: str) -> Union[str, bytes]:
+    """Encode one event in a compact format."""
+    if protocol == MSGPACK:
+        return msgpack.packb(compact(payload), default=str)
+    return json.dumps(compact(payload), default=str, separators=(",", ":"))
+
+
+def _msgpack_header(count: int, fix: int, code16: bytes, code32: bytes) -> bytes:
+    """Header of a MessagePack array or map with `count` items."""
+    if count < 16:
+        return bytes([fix | count])
+    if count < 0x10000:
+        return code16 + struct.pack(">H", count)
+    return code32 + struct.pack(">I", count)
+
+
+def encode_batch(encoded: List[Union[str, bytes]], protocol: str) -> Union[str, bytes]:
+    """Join already encoded events into one frame (an array)."""
+    if protocol == MSGPACK:
+        return _msgpack_header(len(encoded), 0x90, b"\xdc", b"\xdd") + b"".join(encoded)
+    return "[" + ",".join(encoded) + "]"
+
+
+def add_key(encoded: Union[str, bytes], protocol: Optional[str], key: str, value) -> Union[str, bytes]:
+    """Add a key to an already encoded event, without encoding it again.
+
+    `protocol` None is plain JSON, as in ``OutboundEvent.text``.
+    """
+    if protocol == MSGPACK:
+        head = encoded[0]
+        if head & 0xf0 == 0x80:
+            count, body = head & 0x0f, encoded[1:]
+        elif head == 0xde:
+            count, body = struct.unpack_from(">H", encoded, 1)[0], encoded[3:]
+        else:
+            count, body = struct.unpack_from(">I", encoded, 1)[0], encoded[5:]
+        header = _msgpack_header(count + 1, 0x80, b"\xde", b"\xdf")
+        return header + body + msgpack.packb(KEYS.get(key, key)) + msgpack.packb(compact(value, key))
+    if protocol is None:
+        separator = ", " if len(encoded) > 2 else ""
+        return f'{encoded[:-1]}{separator}"{key}": {json.dumps(value, default=str)}}}'
+    separator = "," if len(encoded) > 2 else ""
+    return f'{encoded[:-1]}{separator}"{KEYS.get(key, key)}":{json.dumps(compact(value, key), default=str)}}}'
+